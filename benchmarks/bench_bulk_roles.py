@@ -0,0 +1,86 @@
+""" bench_bulk_roles.py
+    Onboarding a team: granting and revoking roles of many users one pair at a
+    time versus the bulk operations of UserService.
+"""
+
+import time
+import argparse
+
+from sqlalchemy import event
+
+from flashboard import database
+from flashboard.models import UserModel
+from flashboard.services import UserService
+
+from .common import bench_app
+###############################################################################
+
+ROLES = ['operator', 'admin']
+
+
+def add_team(prefix, size):
+    """ insert users directly, registration would be dominated by password hashing """
+
+    emails = ['{}{}@flashboard.io'.format(prefix, idx) for idx in range(size)]
+    database.db_session.execute(UserModel.__table__.insert(), [{
+        'c_name': email.split('@')[0],
+        'c_email': email,
+        'c_password': '-',
+        'c_private_salt': '-',
+        'n_login_count': 0,
+    } for email in emails])
+    database.db_session.commit()
+    return emails
+
+
+def run(size):
+    with bench_app():
+        usvc = UserService()
+        single_team = add_team('single', size)
+        bulk_team = add_team('bulk', size)
+
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def grant_one_by_one():
+            for email in single_team:
+                for role in ROLES:
+                    assert usvc.grant_role(email, role)
+
+        def revoke_one_by_one():
+            for email in single_team:
+                for role in ROLES:
+                    assert usvc.revoke_role(email, role)
+            database.db_session.commit()
+
+        def grant_in_bulk():
+            assert usvc.grant_roles(bulk_team, ROLES) == (size * len(ROLES), '')
+
+        def revoke_in_bulk():
+            assert usvc.revoke_roles(bulk_team, ROLES) == (size * len(ROLES), '')
+
+        engine = database.db_session.get_bind()
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        try:
+            for name, func in [
+                ('grant_role x{}'.format(size * len(ROLES)), grant_one_by_one),
+                ('grant_roles ({} users, {} roles)'.format(size, len(ROLES)), grant_in_bulk),
+                ('revoke_role x{}'.format(size * len(ROLES)), revoke_one_by_one),
+                ('revoke_roles ({} users, {} roles)'.format(size, len(ROLES)), revoke_in_bulk),
+            ]:
+                del statements[:]
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+                print('{:40s} {:>10.1f} ms {:>8d} statements'.format(name, elapsed * 1000.0, len(statements)))
+        finally:
+            event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=1000)
+    args = parser.parse_args()
+    run(args.size)
@@ -0,0 +1,61 @@
+""" bench_bulk_save.py
+    Rows/sec of writing many new rows with save_item one by one, in one
+    db_trasaction, and with save_items / upsert_items. Pass --db-uri of an
+    empty PostgreSQL database to measure it instead of SQLite.
+"""
+
+import time
+import argparse
+
+from flashboard import database
+from flashboard.models import RoleModel
+
+from .common import bench_app
+###############################################################################
+
+
+def run(rows, batch_size, db_uri):
+    with bench_app({'SQLALCHEMY_DATABASE_URI': db_uri} if db_uri else {}):
+        def roles(prefix, desc=None):
+            return [RoleModel('{}-{}'.format(prefix, idx), desc) for idx in range(rows)]
+
+        def save_one_by_one():
+            for item in roles('single'):
+                assert database.save_item(item)
+
+        def save_in_transaction():
+            with database.db_trasaction() as txn:
+                for item in roles('txn'):
+                    assert txn.save_item(item)
+
+        def save_in_bulk():
+            assert database.save_items(roles('bulk'), batch_size) == (rows, [])
+
+        def upsert_new():
+            assert database.upsert_items(roles('upsert'), ['name'], batch_size) == (rows, [])
+
+        def upsert_existing():
+            assert database.upsert_items(roles('upsert', 'updated'), ['name'], batch_size) == (rows, [])
+
+        print('{} on {}'.format(rows, database.engine.url.get_backend_name()))
+        for name, func in [
+            ('save_item x{}'.format(rows), save_one_by_one),
+            ('save_item x{} in db_trasaction'.format(rows), save_in_transaction),
+            ('save_items (batch {})'.format(batch_size), save_in_bulk),
+            ('upsert_items, new rows', upsert_new),
+            ('upsert_items, existing rows', upsert_existing),
+        ]:
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            database.db_session.remove()
+            print('{:40s} {:>10.1f} rows/sec {:>10.1f} ms'.format(name, rows / elapsed, elapsed * 1000.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rows', type=int, default=2000)
+    parser.add_argument('-b', '--batch-size', type=int, default=database.BULK_BATCH_SIZE)
+    parser.add_argument('--db-uri', default=None)
+    args = parser.parse_args()
+    run(args.rows, args.batch_size, args.db_uri)
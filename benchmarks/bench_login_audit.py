@@ -0,0 +1,64 @@
+""" bench_login_audit.py
+    Throughput of many concurrent logins to the same service account, with
+    login audit fields written synchronously or queued for a write-behind
+    flusher.
+"""
+
+import time
+import argparse
+import threading
+
+from flashboard import database
+from flashboard.buffers import login_audit_buffer
+from flashboard.services import UserService
+
+from .common import bench_app, BENCH_EMAIL
+###############################################################################
+
+
+def run(threads, logins):
+    with bench_app() as app:
+        usvc = UserService()
+
+        def login_count():
+            return usvc.load_user(BENCH_EMAIL).login_count
+
+        def login(idx, failures):
+            try:
+                for _ in range(logins):
+                    with app.test_request_context(environ_base={'REMOTE_ADDR': '10.0.0.{}'.format(idx)}):
+                        if not UserService().login_user(BENCH_EMAIL, False, '10.0.0.{}'.format(idx)):
+                            failures.append(idx)
+            finally:
+                database.db_session.remove()
+
+        for write_behind in [False, True]:
+            app.config['LOGIN_AUDIT_WRITE_BEHIND'] = write_behind
+            login_audit_buffer.flush()
+            database.db_session.remove()
+            before = login_count()
+
+            failures = []
+            workers = [threading.Thread(target=login, args=(idx, failures)) for idx in range(threads)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+            login_audit_buffer.flush()
+            database.db_session.remove()
+            total = threads * logins
+            name = 'login_user x{} threads ({})'.format(threads, 'write-behind' if write_behind else 'sync')
+            print('{:40s} {:>10.1f} logins/sec  failed {:>5d}  counted {:>5d}/{}'.format(
+                name, total / elapsed, len(failures), login_count() - before, total
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--threads', type=int, default=8)
+    parser.add_argument('-l', '--logins', type=int, default=100)
+    args = parser.parse_args()
+    run(args.threads, args.logins)
@@ -0,0 +1,85 @@
+""" bench_login_throttle.py
+    Latency of legitimate logins through the API while other accounts are
+    under a credential stuffing attack, with and without login throttling.
+"""
+
+import json
+import time
+import argparse
+import threading
+
+from flashboard.services import UserService
+
+from .common import bench_app, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+THROTTLE_SETTINGS = {
+    'LOGIN_THROTTLE_IP_LIMIT': 5,
+    'LOGIN_THROTTLE_ACCOUNT_LIMIT': 3,
+}
+NO_THROTTLE_SETTINGS = {
+    'LOGIN_THROTTLE_IP_LIMIT': 0,
+    'LOGIN_THROTTLE_ACCOUNT_LIMIT': 0,
+}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)] * 1000.0
+
+
+def run_case(name, settings, attackers, logins):
+    with bench_app(settings) as app:
+        # accounts under attack
+        victims = ['victim{}@flashboard.io'.format(idx) for idx in range(attackers)]
+        usvc = UserService()
+        for idx, email in enumerate(victims):
+            user, token, error = usvc.register_user('victim{}'.format(idx), email, BENCH_PASSWORD)
+            assert user, error
+
+        latency = []
+        attempts = []
+        done = threading.Event()
+
+        def login(client, email, password, login_ip):
+            return client.post('/api/user/login', data=json.dumps({
+                'email': email,
+                'password': password,
+            }), headers={'Content-Type': 'application/json', 'X-Real-IP': login_ip})
+
+        def attack(idx):
+            client = app.test_client()
+            while not done.is_set():
+                resp = login(client, victims[idx], 'Guess{:03d}'.format(len(attempts)), '10.66.0.{}'.format(idx))
+                attempts.append(resp.status_code)
+
+        workers = [threading.Thread(target=attack, args=(idx,)) for idx in range(attackers)]
+        for worker in workers:
+            worker.start()
+
+        client = app.test_client()
+        for _ in range(logins):
+            start = time.perf_counter()
+            resp = login(client, BENCH_EMAIL, BENCH_PASSWORD, '10.0.0.1')
+            latency.append(time.perf_counter() - start)
+            assert resp.status_code == 200
+
+        done.set()
+        for worker in workers:
+            worker.join()
+
+        print('{:24s} legitimate logins p50 {:>8.1f} ms  p95 {:>8.1f} ms | '
+              'attack requests {:>5d}  throttled {:>5d}'.format(
+                  name, percentile(latency, 50), percentile(latency, 95),
+                  len(attempts), attempts.count(429),
+              ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-a', '--attackers', type=int, default=4)
+    parser.add_argument('-l', '--logins', type=int, default=5)
+    args = parser.parse_args()
+    run_case('no attack', THROTTLE_SETTINGS, 0, args.logins)
+    run_case('attack, no throttle', NO_THROTTLE_SETTINGS, args.attackers, args.logins)
+    run_case('attack, throttle', THROTTLE_SETTINGS, args.attackers, args.logins)
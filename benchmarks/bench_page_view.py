@@ -0,0 +1,57 @@
+""" bench_page_view.py
+    Requests/sec and SQL statements per request of an authenticated page view,
+    with and without the identity cache or the session snapshot of
+    Flask-Login's user_loader.
+"""
+
+import argparse
+
+from sqlalchemy import event
+
+from flashboard import database
+from flashboard.identity import init_identity
+
+from .common import bench_app, timed, report, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(count):
+    with bench_app() as app:
+        client = app.test_client()
+        resp = client.post('/sys/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        assert resp.status_code == 302
+
+        statements = []
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def view():
+            resp = client.get('/sys/home')
+            assert resp.status_code == 200
+
+        engine = database.db_session.get_bind()
+        event.listen(engine, 'before_cursor_execute', on_execute)
+        try:
+            for name, cache_size, snapshot in [
+                ('/sys/home (identity cache off)', 0, False),
+                ('/sys/home (identity cache on)', 4096, False),
+                ('/sys/home (session snapshot)', 0, True),
+            ]:
+                app.config['USER_IDENTITY_CACHE_SIZE'] = cache_size
+                app.config['SESSION_USER_SNAPSHOT'] = snapshot
+                init_identity(app)
+                view()
+
+                del statements[:]
+                report(name, count, timed(view, count))
+                print('{:48s} {:>10.1f} statements/request'.format('', len(statements) / count))
+        finally:
+            event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    args = parser.parse_args()
+    run(args.count)
@@ -0,0 +1,51 @@
+""" bench_password_cost.py
+    Calibrated rounds, actual verify time and login throughput through the API
+    for several targets of SECURITY_PASSWORD_TARGET_MS.
+"""
+
+import json
+import time
+import argparse
+
+from flashboard.hashing import password_hasher, init_hashing
+
+from .common import bench_app, timed, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(targets, logins):
+    with bench_app() as app:
+        client = app.test_client()
+        headers = {'Content-Type': 'application/json'}
+        body = json.dumps({'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+
+        def login():
+            resp = client.post('/api/user/login', data=body, headers=headers)
+            assert resp.status_code == 200
+
+        for target_ms in targets:
+            app.config['SECURITY_PASSWORD_TARGET_MS'] = target_ms
+            init_hashing(app)
+
+            # the first login rehashes the password with new rounds
+            login()
+
+            scheme = password_hasher.context_settings['default']
+            rounds = password_hasher.context_settings.get(scheme + '__default_rounds')
+            hashed = password_hasher.hash(BENCH_PASSWORD)
+            start = time.perf_counter()
+            password_hasher.verify(BENCH_PASSWORD, hashed)
+            verify_ms = (time.perf_counter() - start) * 1000.0
+
+            elapsed = timed(login, logins)
+            print('target {:>5d} ms  {} rounds {:>9d}  verify {:>8.1f} ms  logins {:>7.1f}/sec'.format(
+                target_ms, scheme, rounds, verify_ms, logins / elapsed
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-l', '--logins', type=int, default=20)
+    parser.add_argument('-t', '--targets', type=int, nargs='+', default=[25, 50, 100, 200])
+    args = parser.parse_args()
+    run(args.targets, args.logins)
@@ -0,0 +1,85 @@
+""" bench_password_hashing.py
+    Latency of concurrent logins through the API, hashing passwords inline or
+    in the process pool, and the latency of cheap requests served meanwhile.
+    Logins beyond the pool size plus queue limit are rejected with 503.
+"""
+
+import json
+import time
+import argparse
+import threading
+
+from .common import bench_app, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)] * 1000.0
+
+
+def run_case(name, pool_size, queue_limit, threads, logins):
+    with bench_app({
+        'PASSWORD_HASH_POOL_SIZE': pool_size,
+        'PASSWORD_HASH_QUEUE_LIMIT': queue_limit,
+    }) as app:
+        headers = {'Content-Type': 'application/json'}
+        body = json.dumps({'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        login_latency = []
+        rejected = []
+        probe_latency = []
+        done = threading.Event()
+
+        def login_storm():
+            client = app.test_client()
+            for _ in range(logins):
+                start = time.perf_counter()
+                resp = client.post('/api/user/login', data=body, headers=headers)
+                if resp.status_code == 503:
+                    rejected.append(time.perf_counter() - start)
+                else:
+                    assert resp.status_code == 200
+                    login_latency.append(time.perf_counter() - start)
+
+        def probe():
+            # a cheap request which never touches password hashing
+            client = app.test_client()
+            while not done.is_set():
+                start = time.perf_counter()
+                client.get('/api/user/logout', headers=headers)
+                probe_latency.append(time.perf_counter() - start)
+                time.sleep(0.05)
+
+        workers = [threading.Thread(target=login_storm) for _ in range(threads)]
+        prober = threading.Thread(target=probe)
+
+        start = time.perf_counter()
+        prober.start()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+        done.set()
+        prober.join()
+
+        print('{:24s} logins {:>6.2f}/sec  p50 {:>8.1f} ms  p95 {:>8.1f} ms  rejected {:>3d} | '
+              'other requests p50 {:>8.1f} ms  max {:>8.1f} ms'.format(
+                  name, len(login_latency) / elapsed,
+                  percentile(login_latency, 50), percentile(login_latency, 95), len(rejected),
+                  percentile(probe_latency, 50), max(probe_latency) * 1000.0,
+              ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--threads', type=int, default=4)
+    parser.add_argument('-l', '--logins', type=int, default=2)
+    parser.add_argument('-p', '--pool-size', type=int, default=2)
+    parser.add_argument('-q', '--queue-limit', type=int, default=2)
+    args = parser.parse_args()
+    run_case('inline', 0, 0, args.threads, args.logins)
+    run_case(
+        'pool({}+{})'.format(args.pool_size, args.queue_limit),
+        args.pool_size, args.queue_limit, args.threads, args.logins
+    )
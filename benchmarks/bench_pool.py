@@ -0,0 +1,67 @@
+""" bench_pool.py
+    Throughput and checkout wait time reported by get_pool_stats for several
+    pool sizes, with more threads than connections. Each unit of work holds a
+    connection for a query and some think time, like a request does.
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+
+from sqlalchemy import create_engine, text
+
+from flashboard import database
+###############################################################################
+
+
+def run_case(db_uri, pool_size, threads, requests, hold_ms):
+    engine = create_engine(
+        db_uri,
+        poolclass=database.TimedQueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_timeout=30,
+        connect_args={'check_same_thread': False},
+    )
+    database.engines[db_uri] = engine
+    try:
+        def work():
+            for _ in range(requests):
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1')).scalar()
+                    time.sleep(hold_ms / 1000.0)
+
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+
+        stats = database.get_pool_stats()[db_uri]
+        print('pool_size {:>3d}  threads {:>3d}  {:>8.1f} req/sec  avg wait {:>7.2f} ms  max wait {:>7.2f} ms'.format(
+            pool_size, threads, threads * requests / elapsed,
+            stats['avg_wait_time'] * 1000.0, stats['max_wait_time'] * 1000.0,
+        ))
+    finally:
+        database.engines.pop(db_uri).dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--threads', type=int, default=16)
+    parser.add_argument('-r', '--requests', type=int, default=100)
+    parser.add_argument('--hold-ms', type=float, default=2.0)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[2, 4, 8, 16])
+    args = parser.parse_args()
+
+    db_fd, db_path = tempfile.mkstemp()
+    try:
+        for size in args.sizes:
+            run_case('sqlite:///' + db_path, size, args.threads, args.requests, args.hold_ms)
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
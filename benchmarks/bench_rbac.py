@@ -0,0 +1,73 @@
+""" bench_rbac.py
+    Overhead of the RBAC access check of a decorated view, resolving the roles
+    of the module on every call versus the bitmask compiled by @rbac_module,
+    with and without the permission cache of effective roles.
+"""
+
+import argparse
+
+from flask_login import login_user, current_user
+
+from config.settings import Settings
+from flashboard.identity import UserIdentity, init_identity
+from flashboard.rbac import rbac_module, module_mask, user_role_mask
+from flashboard.services import UserService
+from flashboard.utils import flatten
+
+from .common import bench_app, timed
+###############################################################################
+
+
+def legacy_check(*module_names):
+    """ the check done by every call of a decorated view before roles were compiled """
+
+    usvc = UserService()
+    settings = Settings()
+    mapped_roles = flatten([
+        settings.RBAC_CONTROL[module] if module in settings.RBAC_CONTROL else None for module in module_names
+    ])
+    mapped_roles = list(set(mapped_roles))
+    return any(usvc.has_role(current_user, role) for role in mapped_roles)
+
+
+def report_ns(name, count, elapsed, baseline=None):
+    """ print time per call, and the overhead over baseline if provided """
+
+    line = '{:48s} {:>10.0f} ns/call'.format(name, elapsed * 1e9 / count)
+    if baseline is not None:
+        line += ' {:>10.0f} ns overhead'.format((elapsed - baseline) * 1e9 / count)
+    print(line)
+
+
+def run(count):
+    with bench_app() as app:
+        user = UserIdentity(1, 'bench@flashboard.io', 'bench', True, True, None, None, ['user'])
+
+        def view():
+            return 'OK'
+
+        decorated = rbac_module('home')(view)
+        mask = module_mask('home')
+
+        with app.test_request_context():
+            login_user(user)
+            assert legacy_check('home') and decorated() == 'OK'
+
+            baseline = timed(view, count)
+            report_ns('undecorated view', count, baseline)
+            report_ns('roles resolved per call', count, timed(lambda: legacy_check('home') and view(), count), baseline)
+            report_ns('compiled bitmask (@rbac_module)', count, timed(decorated, count), baseline)
+            report_ns('compiled bitmask, plain user', count, timed(lambda: user_role_mask(user.role_names) & mask, count), baseline)
+
+            # effective roles are loaded from database on every check
+            app.config['PERMISSION_CACHE_SIZE'] = 0
+            init_identity(app)
+            checks = count // 100
+            report_ns('@rbac_module (permission cache off)', checks, timed(decorated, checks), baseline * checks / count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=100000)
+    args = parser.parse_args()
+    run(args.count)
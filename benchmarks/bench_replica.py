@@ -0,0 +1,78 @@
+""" bench_replica.py
+    Statements sent to the primary and to a read replica by read-heavy
+    knowall catalog pages, without and with SQLALCHEMY_REPLICA_URIS.
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+
+from sqlalchemy import event
+
+from flashboard import database
+from knowall import models  # noqa: F401
+from knowall.services import TableService
+from knowall.views import init_view
+
+from .common import bench_app, timed, report, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(count, tables):
+    with bench_app() as app:
+        init_view(app, '/knowall')
+
+        tsvc = TableService()
+        names = ['bench_table_{}'.format(idx) for idx in range(tables)]
+        for name in names:
+            assert tsvc.create(name, 'Table of the catalog', 1, 'bench-project')
+
+        client = app.test_client()
+        resp = client.post('/sys/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+        assert resp.status_code == 302
+
+        primary_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+        db_fd, replica_path = tempfile.mkstemp()
+        shutil.copyfile(primary_path, replica_path)
+        replica_uri = 'sqlite:///' + replica_path
+
+        pages = ['/knowall/'] + ['/knowall/tables/' + name for name in names]
+        counts = {}
+
+        def on_execute(conn, cursor, statement, parameters, context, executemany):
+            key = 'replica' if str(conn.engine.url) == replica_uri else 'primary'
+            counts[key] = counts.get(key, 0) + 1
+
+        def browse():
+            for page in pages:
+                assert client.get(page).status_code == 200
+
+        engines = [database.get_engine(app), database.get_engine(app, replica_uri)]
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', on_execute)
+        try:
+            for replicas in [[], [replica_uri]]:
+                app.config['SQLALCHEMY_REPLICA_URIS'] = replicas
+                database.init_db(app)
+                browse()
+
+                counts.clear()
+                name = 'catalog pages ({})'.format('replica' if replicas else 'primary only')
+                report(name, count * len(pages), timed(browse, count))
+                print('{:48s} primary {:>6.2f}  replica {:>6.2f} statements/page'.format(
+                    '', counts.get('primary', 0) / (count * len(pages)), counts.get('replica', 0) / (count * len(pages))
+                ))
+        finally:
+            for engine in engines:
+                event.remove(engine, 'before_cursor_execute', on_execute)
+            os.close(db_fd)
+            os.unlink(replica_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=50)
+    parser.add_argument('-t', '--tables', type=int, default=20)
+    args = parser.parse_args()
+    run(args.count, args.tables)
@@ -0,0 +1,46 @@
+""" bench_sql_stats.py
+    Overhead of the per-request SQL instrumentation on an authenticated page
+    view and on single statements, with SQL_STATS disabled and enabled.
+"""
+
+import argparse
+
+from sqlalchemy import text
+
+from flashboard import database
+from flashboard.sqlstats import sql_stats
+
+from .common import bench_app, timed, report, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(count):
+    # engine hooks can't be removed by another application, so measure without them first
+    for enabled in [False, True]:
+        with bench_app({'SQL_STATS': enabled, 'SQL_STATS_HEADER': enabled, 'USER_IDENTITY_CACHE_SIZE': 0}) as app:
+            client = app.test_client()
+            resp = client.post('/sys/login', data={'email': BENCH_EMAIL, 'password': BENCH_PASSWORD})
+            assert resp.status_code == 302
+
+            def view():
+                resp = client.get('/sys/home')
+                assert resp.status_code == 200
+
+            def statement():
+                database.db_session.execute(text('SELECT 1')).scalar()
+
+            suffix = '(SQL_STATS {})'.format('on' if enabled else 'off')
+            report('/sys/home ' + suffix, count, timed(view, count))
+            report('SELECT 1 ' + suffix, count * 10, timed(statement, count * 10))
+            if enabled:
+                stats = sql_stats.snapshot()['flashboard.home']
+                print('{:48s} {:>10.2f} statements/request {:>7.3f} ms db time/request'.format(
+                    '', stats['avg_statements'], stats['avg_db_time'] * 1000.0
+                ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    args = parser.parse_args()
+    run(args.count)
@@ -0,0 +1,97 @@
+""" bench_token_lookup.py
+    Latency and query plan of TokenService.get_last_one against a
+    sys_token_mgr table seeded with millions of tokens, with and without the
+    ix_token_mgr_owner index.
+"""
+
+import random
+import argparse
+import datetime
+
+from sqlalchemy import event
+
+from flashboard import database
+from flashboard.models import TokenModel
+from flashboard.services import TokenService
+from flashboard.utils import hash_token
+
+from .common import bench_app, timed, report
+###############################################################################
+
+
+def seed_tokens(rows, owners, chunk_size=50000):
+    """ insert rows of tokens for randomly picked owners """
+
+    table = TokenModel.__table__
+    now = datetime.datetime.utcnow()
+    categories = [
+        TokenService.TOKEN_USER_ACTIVATION,
+        TokenService.TOKEN_JWT_ACCESS,
+        TokenService.TOKEN_JWT_REFRESH,
+    ]
+
+    conn = database.db_session.connection()
+    for start in range(0, rows, chunk_size):
+        data = []
+        for idx in range(start, min(start + chunk_size, rows)):
+            create_on = now - datetime.timedelta(seconds=random.randint(0, 60 * 24 * 60 * 60))
+            data.append({
+                'd_create': create_on,
+                'd_expiry': create_on + datetime.timedelta(days=30),
+                'n_access_count': 0,
+                'n_category': random.choice(categories),
+                'c_token_hash': hash_token('bench-token-{}'.format(idx)),
+                'n_random_seed': 0,
+                'n_owner_id': random.randint(1, owners),
+            })
+        conn.execute(table.insert(), data)
+    database.db_session.commit()
+
+
+def explain(name, func):
+    """ print the SQLite query plan of the statement run by func """
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    statement, parameters = statements[-1]
+    # pysqlite caches prepared statements by text, name makes the plan of each case fresh
+    dbapi_conn = database.db_session.connection().connection
+    for row in dbapi_conn.execute('EXPLAIN QUERY PLAN /* {} */ {}'.format(name, statement), parameters):
+        print('    {}'.format(row[-1]))
+
+
+def run(rows, owners, count):
+    with bench_app():
+        seed_tokens(rows, owners)
+        tsvc = TokenService()
+
+        def lookup():
+            tsvc.get_last_one(TokenService.TOKEN_JWT_ACCESS, random.randint(1, owners))
+            database.db_session.expunge_all()
+
+        for indexed in [True, False]:
+            if not indexed:
+                database.db_session.execute('DROP INDEX ix_token_mgr_owner')
+
+            name = 'get_last_one ({} rows, indexed={})'.format(rows, indexed)
+            report(name, count, timed(lookup, count))
+            explain(name, lookup)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rows', type=int, default=2000000)
+    parser.add_argument('-o', '--owners', type=int, default=20000)
+    parser.add_argument('-n', '--count', type=int, default=200)
+    args = parser.parse_args()
+    run(args.rows, args.owners, args.count)
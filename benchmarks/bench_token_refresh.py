@@ -0,0 +1,56 @@
+""" bench_token_refresh.py
+    Requests/sec of login and token refresh through the API, and the token
+    pair generation behind them.
+"""
+
+import json
+import argparse
+
+from flashboard.services import UserService, TokenService
+
+from .common import bench_app, timed, report, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(count, logins):
+    with bench_app() as app:
+        client = app.test_client()
+        headers = {'Content-Type': 'application/json'}
+
+        def login():
+            resp = client.post('/api/user/login', data=json.dumps({
+                'email': BENCH_EMAIL,
+                'password': BENCH_PASSWORD,
+            }), headers=headers)
+            assert resp.status_code == 200
+            return resp.get_json()['refresh_token']
+
+        report('/api/user/login', logins, timed(login, logins))
+
+        tokens = {'refresh_token': login()}
+
+        def refresh():
+            resp = client.post(
+                '/api/user/refresh', data=json.dumps(tokens), headers=headers
+            )
+            assert resp.status_code == 200
+            tokens['refresh_token'] = resp.get_json()['refresh_token']
+
+        report('/api/user/refresh', count, timed(refresh, count))
+
+        tsvc = TokenService()
+        user_id = UserService().load_user(BENCH_EMAIL).id
+
+        def generate():
+            access_token, refresh_token = tsvc.generate_auth_tokens(user_id)
+            assert access_token and refresh_token
+
+        report('TokenService.generate_auth_tokens', count, timed(generate, count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=500)
+    parser.add_argument('-l', '--logins', type=int, default=5)
+    args = parser.parse_args()
+    run(args.count, args.logins)
@@ -0,0 +1,80 @@
+""" bench_token_storage.py
+    Insert rate and index size of sys_token_mgr, when tokens are stored as
+    full JWT strings(before) or as their SHA-256 digest(after).
+"""
+
+import os
+import time
+import random
+import argparse
+import datetime
+import tempfile
+
+import jwt
+from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, LargeBinary
+
+from flashboard.utils import hash_token
+###############################################################################
+
+
+def build_table(metadata, hashed):
+    if hashed:
+        token = Column('c_token_hash', LargeBinary(32), nullable=False, unique=True, index=True)
+    else:
+        token = Column('c_token', String(256), nullable=False, unique=True, index=True)
+    return Table(
+        'sys_token_mgr', metadata,
+        Column('n_token_id', Integer(), primary_key=True, autoincrement=True),
+        token,
+    )
+
+
+def run(rows, chunk_size):
+    now = datetime.datetime.utcnow()
+    tokens = [jwt.encode({
+        'uid': random.randint(1, 20000),
+        'exp': now + datetime.timedelta(days=30),
+        'iat': now,
+        'rds': idx,
+        'cat': 1,
+    }, 'bench', algorithm='HS512').decode('utf-8') for idx in range(rows)]
+    print('average token length : {:.1f}'.format(sum(len(t) for t in tokens) / rows))
+
+    values = {
+        False: tokens,
+        True: [hash_token(token) for token in tokens],
+    }
+
+    for hashed in [False, True]:
+        db_fd, db_path = tempfile.mkstemp()
+        try:
+            engine = create_engine('sqlite:///' + db_path)
+            table = build_table(MetaData(), hashed)
+            table.metadata.create_all(bind=engine)
+            column = 'c_token_hash' if hashed else 'c_token'
+
+            start = time.perf_counter()
+            for offset in range(0, rows, chunk_size):
+                with engine.begin() as conn:
+                    conn.execute(table.insert(), [
+                        {column: value} for value in values[hashed][offset:offset + chunk_size]
+                    ])
+            elapsed = time.perf_counter() - start
+
+            index_size = engine.execute(
+                "SELECT sum(pgsize) FROM dbstat WHERE name = 'ix_sys_token_mgr_{}'".format(column)
+            ).scalar()
+            print('{:24s} {:>10.1f} rows/sec   index size {:>8.1f} MB'.format(
+                column, rows / elapsed, index_size / 1024.0 / 1024.0
+            ))
+        finally:
+            os.close(db_fd)
+            os.unlink(db_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rows', type=int, default=500000)
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+    run(args.rows, args.chunk_size)
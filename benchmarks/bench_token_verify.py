@@ -0,0 +1,45 @@
+""" bench_token_verify.py
+    Requests/sec of an API guarded by token_required, with and without the
+    stateless verification mode(TOKEN_STATELESS_VERIFY).
+"""
+
+import json
+import argparse
+
+from flashboard.services import token_required
+
+from .common import bench_app, timed, report, BENCH_EMAIL, BENCH_PASSWORD
+###############################################################################
+
+
+def run(count):
+    with bench_app() as app:
+        app.add_url_rule(
+            '/bench/ping', 'bench_ping', token_required(lambda: 'pong')
+        )
+        client = app.test_client()
+
+        for stateless in [False, True]:
+            app.config['TOKEN_STATELESS_VERIFY'] = stateless
+
+            resp = client.post('/api/user/login', data=json.dumps({
+                'email': BENCH_EMAIL,
+                'password': BENCH_PASSWORD,
+            }), headers={'Content-Type': 'application/json'})
+            headers = {
+                'Authorization': 'Bearer ' + resp.get_json()['access_token']
+            }
+
+            def ping():
+                assert client.get('/bench/ping', headers=headers).status_code == 200
+
+            report(
+                'token_required (stateless={})'.format(stateless),
+                count, timed(ping, count)
+            )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=2000)
+    run(parser.parse_args().count)
@@ -0,0 +1,78 @@
+""" common.py
+    Shared helpers for benchmarks. Run any of them from the project root:
+
+        python -m benchmarks.bench_token_verify
+"""
+
+import os
+import time
+import logging
+import tempfile
+import contextlib
+
+from flashboard.app import create_app
+from flashboard.database import create_all_tables
+from flashboard.rbac import create_all_roles
+from flashboard.services import UserService
+###############################################################################
+
+BENCH_EMAIL = 'bench@flashboard.io'
+BENCH_PASSWORD = 'Bench001'
+
+
+@contextlib.contextmanager
+def bench_app(extra_config_settings={}):
+    """ create an application on a temporary SQLite database with a confirmed user """
+
+    db_fd, db_path = tempfile.mkstemp()
+    try:
+        config = {
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + db_path,
+            'WTF_CSRF_ENABLED': False,
+            'BABEL_DEFAULT_LOCALE': 'en',
+            'ENABLE_SENTRY': False,
+            'ENABLE_ADMIN': False,
+            'ENABLE_DEBUG_TOOLBAR': False,
+        }
+        config.update(extra_config_settings)
+        app = create_app(config)
+
+        # statement logging would dominate all timings
+        logging.getLogger('sqlalchemy.engine').setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        logging.getLogger('flashboard.slow_query').setLevel(logging.ERROR)
+
+        with app.app_context():
+            import flashboard.models    # noqa: F401
+
+            create_all_tables(app)
+            create_all_roles(True)
+
+            usvc = UserService()
+            user, token, error = usvc.register_user('bench', BENCH_EMAIL, BENCH_PASSWORD)
+            assert user, error
+            result, error = usvc.confirm_user(user, token.token)
+            assert result, error
+
+            yield app
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+def timed(func, count):
+    """ call func count times and return elapsed seconds """
+
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return time.perf_counter() - start
+
+
+def report(name, count, elapsed):
+    """ print throughput of one benchmark case """
+
+    print('{:48s} {:>10.1f} ops/sec {:>10.3f} ms/op'.format(
+        name, count / elapsed, elapsed * 1000.0 / count
+    ))
@@ -1,4 +1,4 @@
-from datetime import timedelta  # noqa F401
+from datetime import timedelta
 
 
 class Settings(dict):
@@ -60,6 +60,10 @@ class Settings(dict):
     }
 
     CELERYBEAT_SCHEDULE = {
+        'purge-expired-tokens': {
+            'task': 'manage.purge_expired_tokens',
+            'schedule': timedelta(hours=1)
+        },
         # 'run-every-1-minute': {
         #     'task': 'worker.print_hello',
         #     'schedule': timedelta(seconds=60)
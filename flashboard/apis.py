@@ -10,6 +10,11 @@ from config.config import all_urls
 from .forms import LoginForm, SignupForm
 from .utils import normal_response, extract_authorization_from_header, ValidationException
 from .services import UserService, TokenService, token_required
+from .database import get_pool_stats
+from .buffers import buffer_stats
+from .sqlstats import sql_stats
+from .hashing import PasswordHasherBusy
+from .throttle import LoginThrottled
 from .dtos import AppDTO
 from .app import send_email
 
@@ -62,6 +67,8 @@ class Login(Resource):
     @auth_ns.expect(AppDTO.auth_details, validate=True)
     @auth_ns.response(200, 'Success', AppDTO.return_token)
     @auth_ns.response(401, _('Invalid username or password or inactive user'))
+    @auth_ns.response(429, _('Too many failed logins, please try again later'))
+    @auth_ns.response(503, _('Server is busy, please try again later'))
     def post(self):
         """ API interface for user login """
 
@@ -85,10 +92,13 @@ class Login(Resource):
         if form.validate_on_submit():
             # check user account and password exist or not
             usvc = UserService()
-            user = usvc.load_valid_user(email, password)
-            login_ip = request.environ.get(
-                'HTTP_X_REAL_IP', request.remote_addr
-            )
+            login_ip = request.remote_addr
+            try:
+                user = usvc.load_valid_user(email, password, login_ip=login_ip)
+            except LoginThrottled:
+                return auth_ns.abort(429, _('Too many failed logins, please try again later'))
+            except PasswordHasherBusy:
+                return auth_ns.abort(503, _('Server is busy, please try again later'))
 
             # update user login information
             if user and usvc.login_user(user, remember=remember_me, login_ip=login_ip):
@@ -143,25 +153,14 @@ class Refresh(Resource):
         if refresh_token is None:
             return auth_ns.abort(401, _('Invalid refresh token'))
 
-        tsvc = TokenService()
-
-        # verify refresh token
-        token, msg = tsvc.verify(
-            TokenService.TOKEN_JWT_REFRESH, None, refresh_token
+        # verify refresh token, purge existing tokens and re-generate them
+        access_token, refresh_token, msg = TokenService().refresh_auth_tokens(
+            refresh_token
         )
-
-        if token is None or token.access_count is None:
-            return auth_ns.abort(401, msg or _('Invalid or expired refresh token'))
-
-        # purge existing tokens
-        tsvc.purge_auth_tokens(token)
-
-        # re-generate refresh token and access token
-        access_token, refresh_token = tsvc.generate_auth_tokens(token.owner_id)
         if access_token and refresh_token:
             return {'access_token': access_token, 'refresh_token': refresh_token}, 200
 
-        return auth_ns.abort(401, _('Failed to re-generate API tokens'))
+        return auth_ns.abort(401, msg or _('Failed to re-generate API tokens'))
 
 
 @auth_ns.route('/register')
@@ -197,7 +196,10 @@ class Register(Resource):
         # input data validation
         if form.validate_on_submit():
             usvc = UserService()
-            user, token, error = usvc.register_user(name, email, password)
+            try:
+                user, token, error = usvc.register_user(name, email, password)
+            except PasswordHasherBusy:
+                return auth_ns.abort(503, _('Server is busy, please try again later'))
             if user and token:
                 # triger activation email
                 confirm_url = login_url(
@@ -223,3 +225,66 @@ class Register(Resource):
             status_code = 401
             msg = form.extract_errors() or _('Invalid username or password')
         return auth_ns.abort(status_code, msg or _('Unknown error'))
+
+
+def change_roles(grant):
+    """ grant or revoke roles of users in bulk, only administrators are allowed """
+
+    usvc = UserService()
+    if not current_user.is_authenticated or not usvc.has_role(current_user, 'admin'):
+        return auth_ns.abort(403, _('Administrator required'))
+
+    users = auth_ns.payload.get('users') or []
+    roles = auth_ns.payload.get('roles') or []
+    if grant:
+        count, error = usvc.grant_roles(users, roles)
+    else:
+        count, error = usvc.revoke_roles(users, roles)
+    if count is None:
+        return auth_ns.abort(500, error or _('Unknown error'))
+    return {'message': error or 'OK', 'count': count}, 200
+
+
+@auth_ns.route('/roles/grant')
+class GrantRoles(Resource):
+    @auth_ns.expect(AppDTO.role_details, validate=True)
+    @auth_ns.response(200, 'Success', AppDTO.return_count)
+    @auth_ns.response(403, _('Administrator required'))
+    @auth_ns.doc(security='JWT')
+    @token_required
+    def post(self):
+        """ API interface for granting roles to users in bulk """
+
+        return change_roles(True)
+
+
+@auth_ns.route('/roles/revoke')
+class RevokeRoles(Resource):
+    @auth_ns.expect(AppDTO.role_details, validate=True)
+    @auth_ns.response(200, 'Success', AppDTO.return_count)
+    @auth_ns.response(403, _('Administrator required'))
+    @auth_ns.doc(security='JWT')
+    @token_required
+    def post(self):
+        """ API interface for revoking roles from users in bulk """
+
+        return change_roles(False)
+
+
+@auth_ns.route('/stats')
+class Stats(Resource):
+    @auth_ns.response(200, 'Success')
+    @auth_ns.response(403, _('Administrator required'))
+    @auth_ns.doc(security='JWT')
+    @token_required
+    def get(self):
+        """ API interface for statistics of connection pools, write-behind buffers and SQL of current worker """
+
+        if not current_user.is_authenticated or not UserService().has_role(current_user, 'admin'):
+            return auth_ns.abort(403, _('Administrator required'))
+
+        return {
+            'pool': get_pool_stats(),
+            'buffers': buffer_stats(),
+            'sql': sql_stats.snapshot(),
+        }, 200
@@ -7,7 +7,7 @@ import logging.config
 
 # import flask and extension packages
 from sqlalchemy.exc import SQLAlchemyError
-from flask import Flask, redirect, request, url_for, g, flash
+from flask import Flask, redirect, request, session, url_for, g, flash
 from flask_login import LoginManager, current_user
 from flask_mail import Mail, Message
 
@@ -19,8 +19,14 @@ from flask_babel import Babel, gettext as _
 # import application packages
 from config.config import config_factory, all_urls
 from config.settings import Settings
-from .database import init_db, create_session
+from .database import init_db, create_session, get_engine
 from .services import UserService
+from .buffers import init_buffers
+from .cache import init_caches
+from .hashing import init_hashing
+from .throttle import init_throttle
+from .identity import init_identity, load_identity
+from .sqlstats import init_sqlstats
 
 # current working folder
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
@@ -84,6 +90,12 @@ def create_app(extra_config_settings={}):
 
     sys_default_lang = app.config.get('BABEL_DEFAULT_LOCALE', None)
 
+    # take the client address from X-Forwarded-For set by trusted proxies
+    proxy_count = app.config.get('PROXY_FIX_X_FOR', 0)
+    if proxy_count:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_count)
+
     # enable colorful logging in development mode
     if app.config.get('ENV', None) == 'development':
         import coloredlogs
@@ -131,9 +143,29 @@ def create_app(extra_config_settings={}):
             app.add_url_rule('/',      view_func=login)
             app.add_url_rule('/index', view_func=login)
 
+        # count statements and database time of requests. Teardown functions
+        # run in reverse order, so it must be initialized before the database
+        # to count the statements flushed by the teardown commit
+        init_sqlstats(app)
+
         # Initialize Global db and create all tables
         init_db(app)
 
+        # bind write-behind buffers
+        init_buffers(app, get_engine(app))
+
+        # initialize caches
+        init_caches(app)
+
+        # start password hashing pool lazily
+        init_hashing(app)
+
+        # throttle failed logins
+        init_throttle(app)
+
+        # cache user identities
+        init_identity(app)
+
         # add default menu item
         add_menu_items([{
             'name': _('Home'),
@@ -239,10 +271,10 @@ def user_loader(user_id):
         timezone = settings.get('BABEL_DEFAULT_TIMEZONE', None)
 
         # user prefference support
-        user = UserService().load_user(user_id)
-        if hasattr(user, 'language'):
-            lang = user.language
-        if hasattr(user, 'timezone'):
+        user = load_identity(session, user_id, UserService().load_user)
+        if user and user.locale:
+            lang = user.locale
+        if user and user.timezone:
             timezone = user.timezone
 
         # cache user language prefference into global variable
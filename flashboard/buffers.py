@@ -0,0 +1,265 @@
+""" buffers.py
+    Write-behind buffers: collect changes in memory and apply them in batches.
+"""
+
+import os
+import abc
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam, func, case
+from sqlalchemy.exc import SQLAlchemyError
+
+from .models import TokenModel, UserModel
+
+log = logging.getLogger(__name__)
+###############################################################################
+
+
+class WriteBehindBuffer(abc.ABC):
+    """ base class of all write-behind buffers
+
+    Pending changes are merged by key in memory, and applied in one batch by a
+    background thread every `flush_interval` seconds, or as soon as there are
+    `max_pending` keys. All pending changes will be flushed on worker shutdown.
+
+    Changes of a failed flush are put back and retried by the next flushes,
+    they're dropped after `max_retries` failures.
+    """
+
+    def __init__(self, flush_interval=5.0, max_pending=1000, max_retries=3):
+        self.engine = None
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+
+        # statistics
+        self.flush_count = 0
+        self.flushed_rows = 0
+        self.retried_rows = 0
+        self.failed_rows = 0
+
+        self._pending = {}
+        # number of failed flushes of pending keys
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def configure(self, engine, flush_interval=None, max_pending=None, max_retries=None):
+        """ bind the buffer to database engine """
+
+        self.engine = engine
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if max_pending is not None:
+            self.max_pending = max_pending
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+    def add(self, key, value):
+        """ add one change into buffer """
+
+        with self._lock:
+            if key in self._pending:
+                value = self.merge(self._pending[key], value)
+            self._pending[key] = value
+            overflow = len(self._pending) >= self.max_pending
+
+        self._ensure_started()
+        if overflow:
+            self._wakeup.set()
+
+    def flush(self):
+        """ apply all pending changes, return the number of applied keys """
+
+        with self._lock:
+            if not self._pending:
+                return 0
+            items, self._pending = self._pending, {}
+
+        try:
+            with self.engine.begin() as conn:
+                self.apply(conn, items)
+        except SQLAlchemyError as exp:
+            log.error('Failed to flush {} : {}'.format(self.__class__.__name__, exp))
+            self._requeue(items)
+            return 0
+
+        with self._lock:
+            for key in items:
+                self._failures.pop(key, None)
+            self.flush_count += 1
+            self.flushed_rows += len(items)
+        return len(items)
+
+    def _requeue(self, items):
+        """ put changes of a failed flush back, before the ones added since then """
+
+        with self._lock:
+            for key, value in items.items():
+                failures = self._failures.get(key, 0) + 1
+                if failures > self.max_retries:
+                    self._failures.pop(key, None)
+                    self.failed_rows += 1
+                    continue
+
+                self._failures[key] = failures
+                if key in self._pending:
+                    value = self.merge(value, self._pending[key])
+                self._pending[key] = value
+                self.retried_rows += 1
+
+    def _flush_at_exit(self):
+        # there is no next flush after shutdown, so retry failed ones right now
+        for _ in range(self.max_retries + 1):
+            self.flush()
+            if not self._pending:
+                break
+
+    @abc.abstractmethod
+    def merge(self, old_value, new_value):
+        """ merge two changes on the same key, old_value is the earlier one """
+
+    @abc.abstractmethod
+    def apply(self, conn, items):
+        """ apply changes within a transaction """
+
+    def _ensure_started(self):
+        # threads do not survive fork, so start the flusher in each worker
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name=self.__class__.__name__, daemon=True
+            )
+            self._thread.start()
+            atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+class TokenStatsBuffer(WriteBehindBuffer):
+    """ buffer of token access statistics, keyed by token id
+
+    Each value is a tuple of (first_access_on, last_access_on, access_count).
+    """
+
+    def merge(self, old_value, new_value):
+        return (
+            min(old_value[0], new_value[0]),
+            max(old_value[1], new_value[1]),
+            old_value[2] + new_value[2],
+        )
+
+    def apply(self, conn, items):
+        table = TokenModel.__table__
+        stmt = table.update().where(
+            table.c.n_token_id == bindparam('b_id')
+        ).values(
+            d_first_access=func.coalesce(table.c.d_first_access, bindparam('b_first')),
+            d_last_access=bindparam('b_last'),
+            n_access_count=table.c.n_access_count + bindparam('b_count'),
+        )
+        conn.execute(stmt, [
+            {'b_id': key, 'b_first': first, 'b_last': last, 'b_count': count}
+            for key, (first, last, count) in items.items()
+        ])
+
+
+class LoginAuditBuffer(WriteBehindBuffer):
+    """ buffer of login audit information, keyed by user id
+
+    Each value is a tuple of (previous_login, current_login, login_count),
+    logins are tuples of (login_at, login_ip). previous_login is None if
+    there is only one pending login, then the current login in database
+    becomes the last login.
+    """
+
+    def merge(self, old_value, new_value):
+        return (old_value[1], new_value[1], old_value[2] + new_value[2])
+
+    def apply(self, conn, items):
+        table = UserModel.__table__
+        shift = bindparam('b_shift')
+        stmt = table.update().where(
+            table.c.n_user_id == bindparam('b_id')
+        ).values(
+            d_last_login_at=case([(shift, table.c.d_current_login_at)], else_=bindparam('b_last_at')),
+            c_last_login_ip=case([(shift, table.c.c_current_login_ip)], else_=bindparam('b_last_ip')),
+            d_current_login_at=bindparam('b_current_at'),
+            c_current_login_ip=bindparam('b_current_ip'),
+            n_login_count=table.c.n_login_count + bindparam('b_count'),
+        )
+        conn.execute(stmt, [
+            {
+                'b_id': key,
+                'b_shift': previous is None,
+                'b_last_at': previous[0] if previous else None,
+                'b_last_ip': previous[1] if previous else None,
+                'b_current_at': current[0],
+                'b_current_ip': current[1],
+                'b_count': count,
+            } for key, (previous, current, count) in items.items()
+        ])
+
+
+# buffer of token access statistics
+token_stats_buffer = TokenStatsBuffer()
+
+# buffer of login audit information
+login_audit_buffer = LoginAuditBuffer()
+
+all_buffers = [token_stats_buffer, login_audit_buffer]
+
+
+def init_buffers(app, engine):
+    """ bind all write-behind buffers with current application """
+
+    token_stats_buffer.configure(
+        engine,
+        app.config.get('TOKEN_STATS_FLUSH_INTERVAL', None),
+        app.config.get('TOKEN_STATS_MAX_PENDING', None),
+        app.config.get('TOKEN_STATS_MAX_RETRIES', None),
+    )
+    login_audit_buffer.configure(
+        engine,
+        app.config.get('LOGIN_AUDIT_FLUSH_INTERVAL', None),
+        app.config.get('LOGIN_AUDIT_MAX_PENDING', None),
+        app.config.get('LOGIN_AUDIT_MAX_RETRIES', None),
+    )
+
+
+def flush_all_buffers():
+    """ flush all write-behind buffers immediately """
+
+    return sum(buffer.flush() for buffer in all_buffers)
+
+
+def buffer_stats():
+    """ get statistics of all write-behind buffers """
+
+    return {
+        buffer.__class__.__name__: {
+            'pending': len(buffer),
+            'flush_count': buffer.flush_count,
+            'flushed_rows': buffer.flushed_rows,
+            'retried_rows': buffer.retried_rows,
+            'failed_rows': buffer.failed_rows,
+        } for buffer in all_buffers
+    }
+
+###############################################################################
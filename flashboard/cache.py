@@ -0,0 +1,299 @@
+""" cache.py
+    In-process caches shared by all requests of current worker, some of them
+    can be shared by all workers on current host through a LocalStore.
+"""
+
+import os
+import time
+import sqlite3
+import calendar
+import datetime
+import threading
+from collections import OrderedDict
+###############################################################################
+
+
+def to_timestamp(value):
+    """ convert naive UTC datetime (or epoch seconds) into epoch seconds """
+
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return float(value)
+
+
+class TokenDenylist(object):
+    """ compact in-process denylist of revoked tokens
+
+    Entries are keyed by token digest (see `utils.hash_token`) and will be
+    dropped automatically once the revoked token itself is expired.
+    """
+
+    def __init__(self, prune_every=1024):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._prune_every = prune_every
+        self._revoked_count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def revoke(self, digest, expiry):
+        """ add digest into denylist until expiry (datetime or epoch seconds) """
+
+        with self._lock:
+            self._entries[digest] = to_timestamp(expiry)
+            self._revoked_count += 1
+            if self._revoked_count % self._prune_every == 0:
+                self._prune(time.time())
+
+    def is_revoked(self, digest):
+        """ check the digest has been revoked or not """
+
+        expiry = self._entries.get(digest)
+        return expiry is not None and expiry > time.time()
+
+    def prune(self):
+        """ drop all expired entries """
+
+        with self._lock:
+            self._prune(time.time())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _prune(self, now):
+        for digest in [key for key, expiry in self._entries.items() if expiry <= now]:
+            del self._entries[digest]
+
+
+class TTLCache(object):
+    """ bounded LRU cache, each entry expires at its own deadline
+
+    It will evict the least recently used entry when it's full, and count the
+    hits and misses for monitoring.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ get the cached value or None """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, value, expiry):
+        """ cache value until expiry (datetime or epoch seconds) """
+
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (to_timestamp(expiry), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class LocalStore(object):
+    """ a local SQLite file shared by all workers on current host
+
+    Each process opens its own connection lazily (connections do not survive
+    fork). Any commit from another connection changes `data_version`, which is
+    cheap to poll and acts as the change notification for in-memory copies.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def connection(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    conn = sqlite3.connect(
+                        self.path,
+                        timeout=self.timeout,
+                        isolation_level=None,
+                        check_same_thread=False
+                    )
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('PRAGMA synchronous=NORMAL')
+                    self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    def execute(self, sql, params=()):
+        """ execute one statement and return all rows """
+
+        with self._lock:
+            return self.connection().execute(sql, params).fetchall()
+
+    def executemany(self, sql, seq_of_params):
+        with self._lock:
+            self.connection().executemany(sql, seq_of_params)
+
+    def data_version(self):
+        """ get the version which will be changed by commits of other connections """
+
+        return self.execute('PRAGMA data_version')[0][0]
+
+
+class SharedTokenDenylist(TokenDenylist):
+    """ denylist of revoked tokens shared by all workers through a LocalStore
+
+    Revocations are written through to the store, and each worker keeps its own
+    in-memory copy for lookups. The copy is brought up to date when the store
+    reports changes from other workers, checked at most every `poll_interval`
+    seconds, so revocations become visible to all workers within that time.
+    """
+
+    def __init__(self, store, poll_interval=0.2, prune_every=1024):
+        super().__init__(prune_every)
+        self.store = store
+        self.poll_interval = poll_interval
+
+        self._data_version = None
+        self._last_seq = 0
+        self._next_poll = 0
+        self._pid = None
+
+        self.store.execute(
+            'CREATE TABLE IF NOT EXISTS token_denylist ('
+            '  seq INTEGER PRIMARY KEY AUTOINCREMENT,'
+            '  digest BLOB NOT NULL UNIQUE,'
+            '  expiry REAL NOT NULL'
+            ')'
+        )
+        self.store.execute(
+            'CREATE INDEX IF NOT EXISTS ix_token_denylist_expiry ON token_denylist(expiry)'
+        )
+
+    def revoke(self, digest, expiry):
+        expiry = to_timestamp(expiry)
+        self.store.execute(
+            'INSERT OR REPLACE INTO token_denylist(digest, expiry) VALUES(?, ?)',
+            (digest, expiry)
+        )
+        super().revoke(digest, expiry)
+
+    def is_revoked(self, digest):
+        if self._pid != os.getpid() or time.monotonic() >= self._next_poll:
+            self.sync()
+        return super().is_revoked(digest)
+
+    def sync(self, force=False):
+        """ load revocations of other workers into the in-memory copy """
+
+        with self._lock:
+            # the in-memory copy inherited from parent process may be stale
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._data_version = None
+                self._last_seq = 0
+
+            self._next_poll = time.monotonic() + self.poll_interval
+            data_version = self.store.data_version()
+            if data_version == self._data_version and not force:
+                return
+            self._data_version = data_version
+
+            rows = self.store.execute(
+                'SELECT seq, digest, expiry FROM token_denylist WHERE seq > ? AND expiry > ? ORDER BY seq',
+                (self._last_seq, time.time())
+            )
+            for seq, digest, expiry in rows:
+                self._entries[digest] = expiry
+            if rows:
+                self._last_seq = rows[-1][0]
+
+    def clear(self):
+        with self._lock:
+            self.store.execute('DELETE FROM token_denylist')
+            self._entries.clear()
+
+    def _prune(self, now):
+        super()._prune(now)
+        self.store.execute('DELETE FROM token_denylist WHERE expiry <= ?', (now,))
+
+
+# local stores opened by current application, keyed by path
+local_stores = {}
+
+# denylist of revoked tokens, in-process one by default
+token_denylist = TokenDenylist()
+
+# decoded JWT payloads keyed by token digest
+jwt_payload_cache = TTLCache()
+
+
+def get_token_denylist():
+    """ get the denylist of revoked tokens """
+    return token_denylist
+
+
+def get_local_store(path):
+    """ get the local store on path, all users of the same file share one """
+
+    if path not in local_stores:
+        local_stores[path] = LocalStore(path)
+    return local_stores[path]
+
+
+def init_caches(app):
+    """ initialize all caches for current application
+
+    The denylist of revoked tokens will be shared across workers if
+    TOKEN_REVOCATION_DB is provided.
+    """
+
+    global token_denylist
+
+    jwt_payload_cache.max_size = app.config.get('JWT_PAYLOAD_CACHE_SIZE', 0)
+    jwt_payload_cache.clear()
+
+    path = app.config.get('TOKEN_REVOCATION_DB', None)
+    if path:
+        token_denylist = SharedTokenDenylist(
+            get_local_store(path),
+            app.config.get('TOKEN_REVOCATION_POLL_INTERVAL', 0.2)
+        )
+    else:
+        token_denylist = TokenDenylist()
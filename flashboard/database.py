@@ -1,40 +1,191 @@
+import re
 import sys
-
-from sqlalchemy.orm import scoped_session, sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
+import time
+import random
+import functools
+import threading
+import contextlib
+import collections
+
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Select, CompoundSelect, Insert, TextClause
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError, TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
 
 from .base import BaseModel
 
 # database engin
 engine = None
 
+# database engines keyed by connection string
+engines = {}
+
 # db sessioon
 db_session = None
 
-# internal control flag for mannual db transaction
-__mannual_on = False
+# default number of rows written per batch by save_items and upsert_items
+BULK_BATCH_SIZE = 500
+
+# textual SQL statements which only read
+READ_SQL = re.compile(r'\s*select\b', re.IGNORECASE)
 ###############################################################################
 
 
+class RoutingSession(Session):
+    """ session which sends reads to replicas and everything else to the primary
+
+    SELECT statements go to a random replica until the session writes
+    anything, then all statements go to the primary for the rest of the
+    session (read-your-writes). Sessions are removed at the end of each
+    request, so the stickiness lasts one request.
+
+    Anything but a SELECT is also recorded as a write of the current
+    transaction, which tells the teardown whether it has to commit.
+    """
+
+    def __init__(self, replicas=(), **kwargs):
+        super().__init__(**kwargs)
+        self.replicas = list(replicas)
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, (Select, CompoundSelect)) and not self._flushing:
+            return self.get_read_bind(mapper)
+
+        mark_writes(self)
+        return super().get_bind(mapper, clause)
+
+    def get_read_bind(self, mapper=None):
+        """ get the bind for read-only statements """
+
+        if not self.replicas or self.info.get('use_primary') or self.info.get('primary_reads'):
+            return super().get_bind(mapper)
+        return random.choice(self.replicas)
+
+
+def use_primary(session):
+    """ send all statements of session to the primary from now on """
+
+    session.info['use_primary'] = True
+
+
+def mark_writes(session):
+    """ record that the transaction of session writes, it is sent to the
+    primary and committed by the teardown of the request
+    """
+
+    use_primary(session)
+    session.info['has_writes'] = True
+
+
+def is_read_clause(clause):
+    """ whether clause is a SELECT statement, which may be sent to replicas """
+
+    if isinstance(clause, str):
+        return READ_SQL.match(clause) is not None
+    if isinstance(clause, TextClause):
+        return READ_SQL.match(clause.text) is not None
+    return isinstance(clause, (Select, CompoundSelect))
+
+
+def get_read_bind(session):
+    """ get the bind for read-only statements of session """
+
+    if isinstance(session, RoutingSession):
+        return session.get_read_bind()
+    return session.get_bind()
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _reset_writes(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('has_writes', None)
+
+
+@event.listens_for(RoutingSession, 'after_begin')
+def _begin_read_only(session, transaction, connection):
+    if session.info.get('read_only') and connection.dialect.name == 'postgresql':
+        connection.execute('SET TRANSACTION READ ONLY')
+
+
+def has_writes(session):
+    """ whether the transaction of session may have anything to commit """
+
+    return bool(session.info.get('has_writes') or session.new or session.dirty or session.deleted)
+
+
+def read_only(func):
+    """ declare that a view never writes, its transaction is started as READ
+    ONLY by databases which support it (PostgreSQL)
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        session = db_session()
+        session.info['read_only'] = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            session.info.pop('read_only', None)
+    return wrapper
+
+
+@contextlib.contextmanager
+def reading_primary(session):
+    """ read from the primary in the with-block, for results which must not lag """
+
+    session.info['primary_reads'] = session.info.get('primary_reads', 0) + 1
+    try:
+        yield session
+    finally:
+        session.info['primary_reads'] -= 1
+
+
+def in_transaction():
+    """ whether the current thread (or greenlet) is inside a db_trasaction """
+
+    return db_session().info.get('txn_depth', 0) > 0
+
+
 class db_trasaction():
+    """ a transaction of the scoped session as a with-block
+
+    Its state lives in the session of the current thread (or greenlet when
+    gevent has patched threading), so concurrent requests of one worker do not
+    share it. Nested blocks run in a SAVEPOINT, an exception raised by an
+    inner block only rolls back the work of that block.
+    """
+
     def __enter__(self):
         """ callback function for entering with-block """
-        global __mannual_on
-        __mannual_on = True
+        session = db_session()
+        depth = session.info.get('txn_depth', 0)
+        self._nested = session.begin_nested() if depth else None
+        session.info['txn_depth'] = depth + 1
+
+        # reads in the transaction must see its writes
+        use_primary(session)
         return self
 
     def __exit__(self, type, value, traceback):
         """ callback function for entering with-block """
-        global __mannual_on
-        __mannual_on = False
+        session = db_session()
+        session.info['txn_depth'] -= 1
 
         # automatic submit the transaction if necessary
         if type is None:
-            db_session.commit()
+            if self._nested is not None:
+                self._nested.commit()
+            else:
+                session.commit()
         else:
-            # rollback all transaction when exception encountered
-            db_session.rollback()
+            # rollback the savepoint, or all transaction of the outermost block
+            if self._nested is not None:
+                self._nested.rollback()
+            else:
+                session.rollback()
 
             # report the exception
             from flask import current_app
@@ -50,19 +201,27 @@ class db_trasaction():
         """ Save the item into relevant database table """
         return save_item(obj_item)
 
+    def save_items(self, obj_items, batch_size=BULK_BATCH_SIZE):
+        """ Save many items into relevant database tables """
+        return save_items(obj_items, batch_size)
+
+    def upsert_items(self, obj_items, index_elements, batch_size=BULK_BATCH_SIZE):
+        """ Insert many items, or update the existing ones """
+        return upsert_items(obj_items, index_elements, batch_size)
+
 
 def save_item(obj_item):
     """ Save the item into relevant database table """
     rst = True
     try:
         db_session.add(obj_item)
-        if not __mannual_on:
+        if not in_transaction():
             db_session.commit()
         else:
             db_session.flush()
     except SQLAlchemyError:
         exp = sys.exc_info()
-        if not __mannual_on:
+        if not in_transaction():
             db_session.rollback()
         rst = False
 
@@ -72,6 +231,108 @@ def save_item(obj_item):
     return rst
 
 
+class Upsert(Insert):
+    """ INSERT ... ON CONFLICT DO UPDATE, spelled the same by SQLite (3.24+)
+    and PostgreSQL
+    """
+
+    def __init__(self, table, index_elements, update_columns):
+        super().__init__(table)
+        self.index_elements = index_elements
+        self.update_columns = update_columns
+
+
+@compiles(Upsert)
+def _compile_upsert(insert, compiler, **kw):
+    quote = compiler.preparer.quote
+    text = compiler.visit_insert(insert, **kw)
+    text += ' ON CONFLICT ({})'.format(', '.join(quote(name) for name in insert.index_elements))
+    if not insert.update_columns:
+        return text + ' DO NOTHING'
+    return text + ' DO UPDATE SET ' + ', '.join(
+        '{0} = excluded.{0}'.format(quote(name)) for name in insert.update_columns
+    )
+
+
+def _batches(obj_items, batch_size):
+    """ split items into lists of at most batch_size items """
+
+    batch = []
+    for obj_item in obj_items:
+        batch.append(obj_item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _write_batches(obj_items, batch_size, write):
+    """ write items batch by batch, each batch in a SAVEPOINT
+
+    A failed batch is rolled back and reported, the others are kept. All the
+    batches are committed at once unless it's called inside a db_trasaction.
+
+    Returns:
+        tuple -- number of items written and list of (batch number, error)
+    """
+
+    count = 0
+    errors = []
+    with db_trasaction():
+        for number, batch in enumerate(_batches(obj_items, batch_size)):
+            try:
+                with db_session.begin_nested():
+                    write(batch)
+                count += len(batch)
+            except SQLAlchemyError as exp:
+                errors.append((number, str(exp)))
+
+    if errors:
+        from flask import current_app
+        current_app.logger.error('{} of {} batches failed: {}'.format(
+            len(errors), number + 1, errors[0][1]
+        ))
+    return count, errors
+
+
+def save_items(obj_items, batch_size=BULK_BATCH_SIZE):
+    """ Save many new items into relevant database tables, rows of a batch are
+    sent with executemany. Unlike save_item, primary keys generated by the
+    database are not fetched back into the items.
+    """
+
+    return _write_batches(obj_items, batch_size, db_session.bulk_save_objects)
+
+
+def upsert_items(obj_items, index_elements, batch_size=BULK_BATCH_SIZE):
+    """ Insert many items into relevant database tables, or update the rows
+    which conflict with them on index_elements (names of attributes covered by
+    a unique index). Only attributes assigned on an item are written.
+    """
+
+    def write(batch):
+        # rows of one executemany must provide the same columns
+        groups = collections.OrderedDict()
+        for obj_item in batch:
+            state = inspect(obj_item)
+            row = {
+                prop.columns[0].key: getattr(obj_item, prop.key)
+                for prop in state.mapper.column_attrs if prop.key in state.dict
+            }
+            groups.setdefault((state.mapper, frozenset(row)), []).append(row)
+
+        for (mapper, keys), rows in groups.items():
+            conflicts = [mapper.attrs[name].columns[0].key for name in index_elements]
+            updates = [
+                column.key for column in mapper.local_table.columns
+                if column.key in keys and column.key not in conflicts and not column.primary_key
+            ]
+            db_session.execute(Upsert(mapper.local_table, conflicts, updates), rows)
+
+    return _write_batches(obj_items, batch_size, write)
+
+
 def init_db(app, db_uri=None):
     """ initialize database session """
 
@@ -91,11 +352,13 @@ def init_db(app, db_uri=None):
             app.logger.error(exception)
 
         try:
-            db_session.commit()
+            # requests which only read have nothing to commit, closing the
+            # session rolls back their transaction
+            if db_session.registry.has() and has_writes(db_session()):
+                db_session.commit()
         except SQLAlchemyError:
             db_session.rollback()
         finally:
-            db_session.close()
             db_session.remove()
 
 
@@ -115,8 +378,72 @@ def create_all_tables(app, drop_all=False):
     BaseModel.metadata.create_all(bind=engine)
 
 
+class TimedQueuePool(QueuePool):
+    """ queue pool which measures how long checkouts wait for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            # other errors, e.g. the database is down, say nothing about the size
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+
+
+def engine_options(app, db_uri):
+    """ get options of create_engine from app.config
+
+    SQLite uses its own pools, so the size options only apply to the others.
+    """
+
+    url = make_url(db_uri)
+
+    config = app.config
+    options = {
+        'pool_pre_ping': config.get('SQLALCHEMY_POOL_PRE_PING', False),
+        'pool_recycle': config.get('SQLALCHEMY_POOL_RECYCLE', -1),
+    }
+    if url.get_driver_name() == 'psycopg2':
+        options['executemany_mode'] = config.get('SQLALCHEMY_EXECUTEMANY_MODE', 'values')
+    if url.get_backend_name() != 'sqlite':
+        options.update({
+            'poolclass': TimedQueuePool,
+            'pool_size': config.get('SQLALCHEMY_POOL_SIZE', 5),
+            'max_overflow': config.get('SQLALCHEMY_MAX_OVERFLOW', 10),
+            'pool_timeout': config.get('SQLALCHEMY_POOL_TIMEOUT', 30),
+        })
+    return options
+
+
+def _begin_before_savepoint(conn, name):
+    """ pysqlite only emits BEGIN before DML, a SAVEPOINT issued first would
+    start the transaction itself and its RELEASE would commit everything
+    """
+
+    dbapi_conn = conn.connection.connection
+    if not dbapi_conn.in_transaction:
+        dbapi_conn.execute('BEGIN')
+
+
 def get_engine(app, db_uri=None):
-    """get db engine
+    """get db engine, one engine (and its pool) is shared by all users of the
+    same connection string
 
     Arguments:
         app {object} -- instance of flask application
@@ -128,17 +455,54 @@ def get_engine(app, db_uri=None):
         object -- instance of db engine
     """
 
-    if db_uri is None:
+    default = db_uri is None
+    if default:
+        db_uri = app.config.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///:memory:')
+
+    if db_uri not in engines:
+        engines[db_uri] = create_engine(db_uri, **engine_options(app, db_uri))
+        if make_url(db_uri).get_backend_name() == 'sqlite':
+            event.listen(engines[db_uri], 'savepoint', _begin_before_savepoint)
+
+    if default:
         # get default global engine
         global engine
-        if engine is None:
-            engine = create_engine(
-                app.config.get('SQLALCHEMY_DATABASE_URI', 'sqlite:///:memory:')
-            )
-        return engine
+        engine = engines[db_uri]
+    return engines[db_uri]
+
+
+def get_pool_stats():
+    """ get a snapshot of connection pools of all engines, keyed by database
+
+    Passwords in connection strings are masked.
+    """
 
-    # get specified database engine
-    return create_engine(db_uri)
+    stats = {}
+    for db_uri, db_engine in engines.items():
+        pool = db_engine.pool
+        item = {
+            'pool': type(pool).__name__,
+            'status': pool.status(),
+        }
+        if isinstance(pool, QueuePool):
+            item.update({
+                'size': pool.size(),
+                'checked_in': pool.checkedin(),
+                'checked_out': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0),
+                'max_overflow': pool._max_overflow,
+                'timeout': pool.timeout(),
+            })
+        if isinstance(pool, TimedQueuePool):
+            item.update({
+                'checkouts': pool.checkouts,
+                'timeouts': pool.timeouts,
+                'wait_time': pool.wait_time,
+                'avg_wait_time': pool.wait_time / pool.checkouts if pool.checkouts else 0.0,
+                'max_wait_time': pool.max_wait_time,
+            })
+        stats[repr(make_url(db_uri))] = item
+    return stats
 
 
 def create_session(app, db_uri=None, scoped=False):
@@ -156,7 +520,11 @@ def create_session(app, db_uri=None, scoped=False):
         # create a Session
         return session()
     else:
+        # reads of the default database are routed to its replicas
+        replica_uris = app.config.get('SQLALCHEMY_REPLICA_URIS', None) if db_uri is None else None
         session_factory = sessionmaker(
+            class_=RoutingSession,
+            replicas=[get_engine(app, uri) for uri in replica_uris or []],
             autocommit=False,
             autoflush=False,
             bind=engine
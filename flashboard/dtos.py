@@ -29,3 +29,13 @@ class AppDTO:
         'email': fields.String(required=True, description=_('email address')),
         'password': fields.String(required=True, description=_('password')),
     })
+
+    role_details = api.model('role_details', {
+        'users': fields.List(fields.String, required=True, description=_('email addresses')),
+        'roles': fields.List(fields.String, required=True, description=_('role names')),
+    })
+
+    return_count = api.model('return_count', {
+        'message': fields.String(description=_('message')),
+        'count': fields.Integer(description=_('number of changed items')),
+    })
@@ -0,0 +1,277 @@
+""" hashing.py
+    Password hashing off the request thread: hashes are computed by a bounded
+    pool of worker processes, so a burst of logins can't stall the whole worker.
+    The cost of hashing is calibrated to a target time on current hardware.
+"""
+
+import os
+import math
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+log = logging.getLogger(__name__)
+
+# schemes of passlib's custom_app_context, hashes in them are upgraded on login
+LEGACY_SCHEMES = ['sha512_crypt', 'sha256_crypt']
+
+# settings of CryptContext if there is no application
+DEFAULT_CONTEXT_SETTINGS = {
+    'schemes': LEGACY_SCHEMES,
+    'default': LEGACY_SCHEMES[0],
+}
+
+# calibrated rounds keyed by (scheme, target_ms)
+_calibrated_rounds = {}
+
+# CryptContext keyed by its settings, in current process
+_contexts = {}
+###############################################################################
+
+
+class PasswordHasherBusy(Exception):
+    """ raised when there are too many password hashing jobs in flight """
+    pass
+
+
+def _get_context(settings):
+    key = repr(sorted(settings.items()))
+    if key not in _contexts:
+        _contexts[key] = CryptContext(**settings)
+    return _contexts[key]
+
+
+def _hash_password(settings, password):
+    return _get_context(settings).hash(password)
+
+
+def _verify_password(settings, password, hashed):
+    return _get_context(settings).verify(password, hashed)
+
+
+def _verify_and_update_password(settings, password, hashed):
+    return _get_context(settings).verify_and_update(password, hashed)
+
+
+def calibrate_rounds(scheme, target_ms):
+    """ get rounds of scheme which take about target_ms to hash a password
+
+    It returns None if the scheme has no rounds setting. Each scheme is
+    calibrated once per process.
+    """
+
+    handler = get_crypt_handler(scheme)
+    if 'rounds' not in handler.setting_kwds:
+        return None
+
+    key = (scheme, target_ms)
+    if key not in _calibrated_rounds:
+        log_cost = handler.rounds_cost == 'log2'
+        if log_cost:
+            sample = max(handler.default_rounds - 3, handler.min_rounds)
+        else:
+            sample = max(handler.default_rounds // 8, handler.min_rounds)
+
+        def measure(rounds):
+            # take the fastest of a few runs to ignore noises
+            sample_handler = handler.using(rounds=rounds)
+            elapsed = None
+            for _ in range(3):
+                start = time.perf_counter()
+                sample_handler.hash('calibration')
+                cost = time.perf_counter() - start
+                elapsed = cost if elapsed is None else min(elapsed, cost)
+            return elapsed
+
+        # grow the sample until it's long enough to be measured precisely
+        elapsed = measure(sample)
+        while not log_cost and elapsed * 5000.0 < target_ms and sample * 2 <= handler.max_rounds:
+            sample *= 2
+            elapsed = measure(sample)
+
+        ratio = target_ms / 1000.0 / max(elapsed, 1e-6)
+        if log_cost:
+            rounds = sample + int(round(math.log2(ratio)))
+        else:
+            # keep 2 significant digits, so rounds are stable between restarts
+            rounds = int(sample * ratio)
+            digits = max(len(str(rounds)) - 2, 0)
+            rounds = int(round(rounds, -digits))
+        rounds = min(max(rounds, handler.min_rounds), handler.max_rounds)
+
+        log.info('Calibrated {} to {} rounds for {} ms'.format(scheme, rounds, target_ms))
+        _calibrated_rounds[key] = rounds
+    return _calibrated_rounds[key]
+
+
+def build_context_settings(scheme, rounds=None, tolerance=0.25):
+    """ build CryptContext settings for scheme, legacy schemes are deprecated
+
+    Hashes with less than `rounds * (1 - tolerance)` rounds are outdated too.
+    Stronger hashes are kept, so workers which calibrate slightly different
+    rounds don't rehash each other's hashes back and forth.
+    """
+
+    settings = {
+        'schemes': [scheme] + [legacy for legacy in LEGACY_SCHEMES if legacy != scheme],
+        'default': scheme,
+        'deprecated': 'auto',
+    }
+    if rounds:
+        if get_crypt_handler(scheme).rounds_cost == 'log2':
+            min_rounds = rounds - 1 if tolerance else rounds
+        else:
+            min_rounds = int(math.ceil(rounds * (1.0 - tolerance)))
+        settings[scheme + '__default_rounds'] = rounds
+        settings[scheme + '__min_rounds'] = min_rounds
+    return settings
+
+
+class PasswordHasher(object):
+    """ compute password hashes in a bounded pool of worker processes
+
+    At most `pool_size + queue_limit` jobs can be in flight at the same time,
+    further callers will wait up to `wait_timeout` seconds for a free slot and
+    get `PasswordHasherBusy` after that. All hashes are computed inline if
+    `pool_size` is 0.
+    """
+
+    def __init__(self, pool_size=0, queue_limit=0, wait_timeout=0, context_settings=None):
+        # statistics
+        self.submitted = 0
+        self.rejected = 0
+
+        self._pool = None
+        self._pid = None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.configure(pool_size, queue_limit, wait_timeout, context_settings)
+
+    def configure(self, pool_size=0, queue_limit=0, wait_timeout=0, context_settings=None):
+        """ resize the pool, the running one will be shut down """
+
+        self.shutdown()
+        self.pool_size = max(pool_size or 0, 0)
+        self.queue_limit = max(queue_limit or 0, 0)
+        self.wait_timeout = wait_timeout or 0
+        self.context_settings = context_settings or DEFAULT_CONTEXT_SETTINGS
+        self._slots = threading.BoundedSemaphore(self.pool_size + self.queue_limit or 1)
+
+    @property
+    def context(self):
+        """ CryptContext of current settings """
+        return _get_context(self.context_settings)
+
+    def hash(self, password):
+        """ get hash of password """
+        return self._call(_hash_password, self.context_settings, password)
+
+    def verify(self, password, hashed):
+        """ check password against its hash """
+        return self._call(_verify_password, self.context_settings, password, hashed)
+
+    def verify_and_update(self, password, hashed):
+        """ check password against its hash, and rehash it if the hash is outdated
+
+        It returns a tuple of (verified, new_hash), new_hash is None if the
+        password is wrong or the hash is up to date.
+        """
+        return self._call(_verify_and_update_password, self.context_settings, password, hashed)
+
+    def needs_update(self, hashed):
+        """ check the hash is made by a deprecated scheme or out-of-range rounds """
+        return self.context.needs_update(hashed)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'queue_limit': self.queue_limit,
+                'in_flight': self._in_flight,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown()
+            self._pool, self._pid = None, None
+
+    def _call(self, func, *args):
+        if not self.pool_size:
+            return func(*args)
+
+        if self.wait_timeout > 0:
+            acquired = self._slots.acquire(timeout=self.wait_timeout)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        if not acquired:
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy('Too many password hashing jobs in flight')
+
+        # counters are also changed by the callback thread of the executor
+        with self._lock:
+            self._in_flight += 1
+            self.submitted += 1
+        try:
+            future = self._executor().submit(func, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future.result()
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _executor(self):
+        # the pool doesn't survive fork, so create it lazily in each worker.
+        # Pool processes are forked from a clean server process which imports
+        # this module only, rather than from the threaded application worker.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    context = multiprocessing.get_context('forkserver')
+                    context.set_forkserver_preload([__name__])
+                    self._pool = ProcessPoolExecutor(
+                        max_workers=self.pool_size, mp_context=context
+                    )
+                    self._pid = os.getpid()
+        return self._pool
+
+
+# shared password hasher of current worker
+password_hasher = PasswordHasher()
+
+
+def init_hashing(app):
+    """ configure the password hasher for current application
+
+    The rounds of SECURITY_PASSWORD_HASH are calibrated to take about
+    SECURITY_PASSWORD_TARGET_MS on current hardware, unless they are fixed by
+    SECURITY_PASSWORD_ROUNDS.
+    """
+
+    scheme = app.config.get('SECURITY_PASSWORD_HASH', None) or DEFAULT_CONTEXT_SETTINGS['default']
+    rounds = app.config.get('SECURITY_PASSWORD_ROUNDS', None)
+    target_ms = app.config.get('SECURITY_PASSWORD_TARGET_MS', 0)
+    if not rounds and target_ms > 0:
+        rounds = calibrate_rounds(scheme, target_ms)
+
+    password_hasher.configure(
+        app.config.get('PASSWORD_HASH_POOL_SIZE', 0),
+        app.config.get('PASSWORD_HASH_QUEUE_LIMIT', 0),
+        app.config.get('PASSWORD_HASH_WAIT_TIMEOUT', 0),
+        build_context_settings(
+            scheme, rounds, app.config.get('SECURITY_PASSWORD_ROUNDS_TOLERANCE', 0.25)
+        ),
+    )
@@ -0,0 +1,383 @@
+""" identity.py
+    Snapshots of user identity cached in each worker or kept in the session,
+    so Flask-Login can load the current user of a page request without
+    touching the database.
+"""
+
+import os
+import time
+import threading
+
+from flask_login import UserMixin
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache, get_local_store
+from .models import UserModel, RoleModel, RolesUsers
+###############################################################################
+
+
+class UserIdentity(UserMixin):
+    """ read-only snapshot of a user for Flask-Login
+
+    Use `UserService().load_raw_user(identity)` to get the model if anything
+    needs to be changed.
+    """
+
+    def __init__(self, id, email, name, actived, authenticated, locale, timezone, role_names):
+        self.id = id
+        self.email = email
+        self.name = name
+        self.actived = actived
+        self.authenticated = authenticated
+        self.locale = locale
+        self.timezone = timezone
+        self.role_names = frozenset(role_names)
+
+    def __repr__(self):
+        return '<UserIdentity %r>' % (self.name)
+
+    @classmethod
+    def from_user(cls, user):
+        """ take snapshot of user model """
+
+        return cls(
+            user.id, user.email, user.name, user.actived, user.authenticated,
+            getattr(user, 'language', None), getattr(user, 'timezone', None),
+            user.role_names,
+        )
+
+    @property
+    def is_active(self):
+        return self.actived
+
+    @property
+    def is_authenticated(self):
+        return self.authenticated
+
+    def get_id(self):
+        return str(self.email)
+
+    def has_role(self, role):
+        """ check the user has role (name or RoleModel) or not """
+        return (role.name if isinstance(role, RoleModel) else role) in self.role_names
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'email': self.email,
+            'name': self.name,
+            'actived': self.actived,
+            'authenticated': self.authenticated,
+            'locale': self.locale,
+            'timezone': self.timezone,
+            'role_names': sorted(self.role_names),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class UserVersions(object):
+    """ in-process version counters of users, bumped on every change of a user
+
+    Counters start from a random base, so snapshots taken by other workers or
+    before a restart are never trusted.
+    """
+
+    def __init__(self):
+        self._base = int.from_bytes(os.urandom(4), 'big')
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        return self._versions.get(email, self._base)
+
+    def bump(self, *emails):
+        with self._lock:
+            for email in emails:
+                self._versions[email] = self._versions.get(email, self._base) + 1
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+
+class SharedUserVersions(UserVersions):
+    """ version counters of users shared by all workers through a LocalStore
+
+    Bumps are written through to the store, and each worker keeps its own
+    in-memory copy for lookups. The copy is brought up to date when the store
+    reports changes from other workers, checked at most every `poll_interval`
+    seconds, so bumps become visible to all workers within that time.
+    """
+
+    def __init__(self, store, poll_interval=0.2):
+        super().__init__()
+        self._base = 0
+        self.store = store
+        self.poll_interval = poll_interval
+
+        self._data_version = None
+        self._last_seq = 0
+        self._next_poll = 0
+        self._pid = None
+
+        self.store.execute(
+            'CREATE TABLE IF NOT EXISTS user_version ('
+            '  email TEXT PRIMARY KEY,'
+            '  version INTEGER NOT NULL,'
+            '  seq INTEGER NOT NULL'
+            ')'
+        )
+        self.store.execute(
+            'CREATE INDEX IF NOT EXISTS ix_user_version_seq ON user_version(seq)'
+        )
+
+    def get(self, email):
+        if self._pid != os.getpid() or time.monotonic() >= self._next_poll:
+            self.sync()
+        return super().get(email)
+
+    def bump(self, *emails):
+        # writes are serialized by SQLite, so seq grows in commit order
+        self.store.executemany(
+            'INSERT INTO user_version(email, version, seq) '
+            'VALUES(?, 1, (SELECT IFNULL(MAX(seq), 0) + 1 FROM user_version)) '
+            'ON CONFLICT(email) DO UPDATE SET version = version + 1, seq = excluded.seq',
+            [(email,) for email in emails]
+        )
+        self.sync(force=True)
+
+    def sync(self, force=False):
+        """ load bumps of other workers into the in-memory copy """
+
+        with self._lock:
+            # the in-memory copy inherited from parent process may be stale
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._data_version = None
+                self._last_seq = 0
+
+            self._next_poll = time.monotonic() + self.poll_interval
+            data_version = self.store.data_version()
+            if data_version == self._data_version and not force:
+                return
+            self._data_version = data_version
+
+            rows = self.store.execute(
+                'SELECT seq, email, version FROM user_version WHERE seq > ? ORDER BY seq',
+                (self._last_seq,)
+            )
+            for seq, email, version in rows:
+                self._versions[email] = version
+            if rows:
+                self._last_seq = rows[-1][0]
+
+    def clear(self):
+        with self._lock:
+            self.store.execute('DELETE FROM user_version')
+            self._versions.clear()
+            self._last_seq = 0
+
+
+# identity snapshots keyed by email, stamped with versions of their users
+identity_cache = TTLCache()
+
+# max seconds a snapshot is kept
+identity_ttl = 60
+
+# version counters of users, in-process one until init_identity
+user_versions = UserVersions()
+
+# effective role names of users keyed by email, stamped with their versions
+permission_cache = TTLCache()
+
+# max seconds role names are kept, bounds staleness without shared versions
+permission_ttl = 60
+
+# max seconds a snapshot in the session is trusted, 0 to disable snapshots
+session_snapshot_ttl = 0
+
+# key of the snapshot in the session
+SESSION_SNAPSHOT_KEY = '_user_snapshot'
+
+
+def get_identity(email, loader):
+    """ get identity snapshot of email, call loader to load the user model if
+    it's not cached or the user has been changed since it was cached """
+
+    # take the version first, a bump during loading outdates the entry
+    version = user_versions.get(email)
+    entry = identity_cache.get(email)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    user = _load_user(email, version, loader)
+    if user is None:
+        return None
+    identity = UserIdentity.from_user(user)
+    identity_cache.set(email, (version, identity), time.time() + identity_ttl)
+    return identity
+
+
+def _load_user(email, version, loader):
+    # roles are loaded with the user, keep them for permission checks
+    user = loader(email)
+    if user is not None:
+        permission_cache.set(email, (version, user.role_names), time.time() + permission_ttl)
+    return user
+
+
+def get_user_versions():
+    """ get the version counters of users """
+    return user_versions
+
+
+def get_role_names(email, loader):
+    """ get effective role names of email, call loader to load them if they're
+    not cached or the user has been changed since they were cached """
+
+    # take the version first, a bump during loading outdates the entry
+    version = user_versions.get(email)
+    entry = permission_cache.get(email)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    role_names = loader(email)
+    if role_names is not None:
+        permission_cache.set(email, (version, role_names), time.time() + permission_ttl)
+    return role_names
+
+
+def get_session_identity(session, email, loader):
+    """ get identity snapshot of email kept in the session
+
+    The session cookie is signed with SECRET_KEY, so the snapshot is trusted
+    until the version of the user is bumped or it's older than
+    `session_snapshot_ttl` seconds. Then it is revalidated by calling loader,
+    bypassing the identity cache of current worker.
+    """
+
+    now = time.time()
+    version = user_versions.get(email)
+    snapshot = session.get(SESSION_SNAPSHOT_KEY)
+    if snapshot and snapshot['identity']['email'] == email and \
+            snapshot['version'] == version and now - snapshot['checked_at'] < session_snapshot_ttl:
+        return UserIdentity.from_dict(snapshot['identity'])
+
+    user = _load_user(email, version, loader)
+    if user is None:
+        session.pop(SESSION_SNAPSHOT_KEY, None)
+        return None
+    identity = UserIdentity.from_user(user)
+    session[SESSION_SNAPSHOT_KEY] = {
+        'identity': identity.to_dict(),
+        'version': version,
+        'checked_at': now,
+    }
+    return identity
+
+
+def forget_session_identity(session):
+    """ drop the identity snapshot kept in the session, on logout """
+
+    session.pop(SESSION_SNAPSHOT_KEY, None)
+
+
+def load_identity(session, email, loader):
+    """ load identity of email from the session snapshot if it's enabled, or
+    from the identity cache """
+
+    if session_snapshot_ttl > 0:
+        return get_session_identity(session, email, loader)
+    return get_identity(email, loader)
+
+
+def invalidate_identity(*emails):
+    """ drop cached snapshots of emails, and outdate snapshots in all sessions
+    and cached role names in all workers """
+
+    emails = [email for email in emails if email]
+    if emails:
+        for email in emails:
+            identity_cache.invalidate(email)
+            permission_cache.invalidate(email)
+        user_versions.bump(*emails)
+
+
+def invalidate_identity_on_commit(session, *emails):
+    """ invalidate identities of emails now, and again when session ends
+
+    Other requests may load the old values before current transaction is
+    committed, or the new ones before it is rolled back.
+    """
+
+    invalidate_identity(*emails)
+    if session is not None:
+        session.info.setdefault('changed_identities', set()).update(email for email in emails if email)
+
+
+def init_identity(app):
+    """ configure the identity cache for current application
+
+    Versions of users are shared across workers through USER_VERSION_DB, a
+    relative path is taken from the instance folder. They're kept in process
+    if it's None, changes are then seen by other workers only when their
+    cached identities and roles expire.
+    """
+
+    global identity_ttl, permission_ttl, user_versions, session_snapshot_ttl
+
+    identity_cache.max_size = app.config.get('USER_IDENTITY_CACHE_SIZE', 0)
+    identity_ttl = app.config.get('USER_IDENTITY_CACHE_TTL', 60)
+    identity_cache.clear()
+
+    permission_cache.max_size = app.config.get('PERMISSION_CACHE_SIZE', 0)
+    permission_ttl = app.config.get('PERMISSION_CACHE_TTL', 60)
+    permission_cache.clear()
+
+    path = app.config.get('USER_VERSION_DB', None)
+    if path:
+        if not os.path.isabs(path):
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, path)
+        user_versions = SharedUserVersions(
+            get_local_store(path),
+            app.config.get('USER_VERSION_POLL_INTERVAL', 0.2)
+        )
+    else:
+        user_versions = UserVersions()
+
+    session_snapshot_ttl = app.config.get('SESSION_USER_SNAPSHOT_TTL', 300) \
+        if app.config.get('SESSION_USER_SNAPSHOT', False) else 0
+
+
+def _invalidate_on_flush(target, email):
+    invalidate_identity_on_commit(inspect(target).session, email)
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _on_session_end(session):
+    invalidate_identity(*session.info.pop('changed_identities', ()))
+
+
+@event.listens_for(UserModel, 'after_update')
+@event.listens_for(UserModel, 'after_delete')
+def _on_user_changed(mapper, connection, target):
+    # drop both old and new email if it has been changed
+    for email in inspect(target).attrs.email.history.deleted or []:
+        _invalidate_on_flush(target, email)
+    _invalidate_on_flush(target, target.email)
+
+
+@event.listens_for(RolesUsers, 'after_insert')
+@event.listens_for(RolesUsers, 'after_delete')
+def _on_roles_changed(mapper, connection, target):
+    table = UserModel.__table__
+    email = connection.execute(
+        select([table.c.c_email]).where(table.c.n_user_id == target.user_id)
+    ).scalar()
+    _invalidate_on_flush(target, email)
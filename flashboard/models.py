@@ -1,11 +1,12 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Index, LargeBinary, event
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.sql import func
-from passlib.apps import custom_app_context as pwd_context
 
 from flask_login import UserMixin
 
 from .base import BaseModel
+from .utils import hash_token
+from .hashing import password_hasher
 ###############################################################################
 
 
@@ -70,13 +71,17 @@ class UserModel(UserMixin, BaseModel):
     confirmed_at = Column('d_confirmed_at', DateTime(),
                           comment='Comfirm date')
 
-    # define relationship
+    # define relationship, roles are loaded in the same query as the user
     roles = relationship(
         'RoleModel',
         secondary='sys_map_r2u',
+        lazy='joined',
         backref=backref('sys_user', lazy='dynamic')
     )
 
+    # names of roles, computed on first use
+    _role_names = None
+
     # define methods
     @property
     def is_active(self):
@@ -95,6 +100,18 @@ class UserModel(UserMixin, BaseModel):
 
         return False
 
+    @property
+    def role_names(self):
+        """ frozen set of names of all roles """
+
+        if self._role_names is None:
+            self._role_names = frozenset(role.name for role in self.roles)
+        return self._role_names
+
+    def has_role(self, role):
+        """ check the user has role (name or RoleModel) or not """
+        return (role.name if isinstance(role, RoleModel) else role) in self.role_names
+
     def get_id(self):
         """ Return the email address to satisfy Flask-Login's requirements """
         try:
@@ -111,10 +128,33 @@ class UserModel(UserMixin, BaseModel):
         return '<User %r>' % (self.name)
 
     def hash_password(self, password):
-        self.password = pwd_context.hash(password)
+        self.password = password_hasher.hash(password)
 
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password)
+        return password_hasher.verify(password, self.password)
+
+    def verify_and_update_password(self, password):
+        """ verify password, and rehash it if the stored hash is outdated
+
+        It returns a tuple of (verified, updated).
+        """
+        verified, new_hash = password_hasher.verify_and_update(password, self.password)
+        if verified and new_hash:
+            self.password = new_hash
+        return verified, bool(verified and new_hash)
+
+
+@event.listens_for(UserModel.roles, 'append')
+@event.listens_for(UserModel.roles, 'remove')
+@event.listens_for(UserModel.roles, 'set')
+def _on_roles_changed(target, *args):
+    target._role_names = None
+
+
+@event.listens_for(UserModel, 'refresh')
+@event.listens_for(UserModel, 'expire')
+def _on_user_reloaded(target, *args):
+    target._role_names = None
 
 
 class RolesUsers(BaseModel):
@@ -130,14 +170,18 @@ class RolesUsers(BaseModel):
 
 class TokenModel(BaseModel):
     __tablename__ = 'sys_token_mgr'
+    __table_args__ = (
+        # covering index for TokenService.get_last_one
+        Index('ix_token_mgr_owner', 'n_category', 'n_owner_id', 'd_create', 'd_expiry'),
+    )
 
     id = Column('n_token_id', Integer(), primary_key=True,
                 autoincrement=True, comment='Token ID')
 
     create_on = Column('d_create', DateTime(),
                        nullable=False, default=func.now(), comment='Create date')
-    expiry_on = Column('d_expiry', DateTime(),
-                       nullable=False, comment='Expiry date')
+    expiry_on = Column('d_expiry', DateTime(), nullable=False,
+                       index=True, comment='Expiry date')
     first_access_on = Column('d_first_access', DateTime(),
                              nullable=True, comment='First access date')
     last_access_on = Column('d_last_access', DateTime(),
@@ -147,10 +191,25 @@ class TokenModel(BaseModel):
 
     category = Column('n_category', Integer(), default=0,
                       nullable=False, comment='Token category')
-    token = Column('c_token', String(256), nullable=False,
-                   unique=True, comment='Token')
+    token_hash = Column('c_token_hash', LargeBinary(32), nullable=False,
+                        unique=True, index=True, comment='SHA-256 digest of token')
     random_seed = Column('n_random_seed', Integer(),
                          default=0, nullable=True, comment='Random seed')
 
     owner_id = Column('n_owner_id', Integer(),
                       ForeignKey('sys_user.n_user_id'), comment='Owner ID')
+
+    # Only the digest of token is stored. The plain token is known for tokens
+    # created or verified in current process only, it can't be loaded from database.
+    _token = None
+
+    @property
+    def token(self):
+        return self._token
+
+    @token.setter
+    def token(self, value):
+        self._token = value
+        digest = hash_token(value) if value else None
+        if self.token_hash != digest:
+            self.token_hash = digest
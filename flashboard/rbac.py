@@ -1,46 +1,83 @@
 import functools
+import threading
 
 from flask import abort, current_app
 from flask_login import current_user
 
 from config.settings import Settings
-from .utils import flatten
 from .services import UserService
 ###############################################################################
 
+# bit of each role, assigned in the order of RBAC_ROLES and then on first use
+_role_bits = {role: 1 << idx for idx, role in enumerate(Settings().RBAC_ROLES)}
+_role_bits_lock = threading.Lock()
+
+# role masks of users, keyed by the frozenset of their role names
+_user_masks = {}
+_max_user_masks = 4096
+
+
+def role_bit(role):
+    """ get the bit of role name """
+
+    bit = _role_bits.get(role)
+    if bit is None:
+        with _role_bits_lock:
+            bit = _role_bits.setdefault(role, 1 << len(_role_bits))
+    return bit
+
+
+def role_mask(role_names):
+    """ encode role names into an integer bitmask """
+
+    mask = 0
+    for role in role_names:
+        mask |= role_bit(role)
+    return mask
+
+
+def user_role_mask(role_names):
+    """ get the role mask of a user from the frozenset of its role names """
+
+    if not role_names:
+        return 0
+
+    mask = _user_masks.get(role_names)
+    if mask is None:
+        if len(_user_masks) >= _max_user_masks:
+            _user_masks.clear()
+        mask = _user_masks[role_names] = role_mask(role_names)
+    return mask
+
+
+def module_mask(*module_names):
+    """ compile the roles of RBAC modules into an integer bitmask """
+
+    control = Settings().RBAC_CONTROL
+    return role_mask({
+        role for module in module_names for role in control.get(module, ())
+    })
+
 
 def rbac_module(*module_names):
     """
     This decorator mark current view belong to which RBAC module
+
+    Roles of the modules are compiled into a bitmask once, so the access check
+    is a single AND with the role mask of current user, whose role names come
+    from the permission cache.
     """
+    mask = module_mask(*module_names)
+
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            usvc = UserService()
-
-            # get mapping
-            settings = Settings()
-            mapped_roles = flatten([
-                settings.RBAC_CONTROL[module] if module in settings.RBAC_CONTROL else None for module in module_names
-            ])
-            # de-duplicate
-            mapped_roles = list(set(mapped_roles))
-
             # verify RBAC access control
-            role_available = False
-            for role in mapped_roles:
-                if usvc.has_role(current_user, role):
-                    role_available = True
-
-            # access control
-            try:
-                if role_available:
-                    return func(*args, **kwargs)
-                else:
-                    current_app.logger.warning('Invalid access!!')
-                    abort(401)
-            finally:
-                pass
+            if user_role_mask(UserService().get_role_names(current_user)) & mask:
+                return func(*args, **kwargs)
+
+            current_app.logger.warning('Invalid access!!')
+            abort(401)
         return wrapper
     return decorator
 
@@ -55,5 +92,4 @@ def create_all_roles(drop_existing=False):
         RoleModel.query.delete()
 
     with db_trasaction() as txn:
-        for role, desc in Settings().RBAC_ROLES.items():
-            txn.save_item(RoleModel(role, desc))
+        txn.upsert_items([RoleModel(role, desc) for role, desc in Settings().RBAC_ROLES.items()], ['name'])
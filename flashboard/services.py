@@ -1,16 +1,25 @@
+import hmac
+import time
+import secrets
 import datetime
-import random
 
-from sqlalchemy import or_
+from sqlalchemy import or_, and_, bindparam, select, exists
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext import baked
+from werkzeug.local import LocalProxy
 from flask_login import login_user, logout_user
 from flask_babel import lazy_gettext as _
 from flask_restplus.errors import abort as api_abort
 
 from config.settings import Settings
 from .base import BaseModel
-from .database import db_trasaction, save_item
+from .database import db_trasaction, save_item, save_items, upsert_items, mark_writes, get_read_bind, is_read_clause, reading_primary
 from .models import UserModel, RoleModel, RolesUsers, TokenModel
-from .utils import is_strong, prepare_for_hash, generate_random_salt
+from .cache import get_token_denylist, jwt_payload_cache
+from .buffers import token_stats_buffer, login_audit_buffer
+from .throttle import get_login_throttle
+from .identity import UserIdentity, get_role_names, forget_session_identity, invalidate_identity_on_commit
+from .utils import is_strong, prepare_for_hash, generate_random_salt, hash_token
 from .utils import encode_jwt_token, decode_jwt_token, extract_authorization_from_header
 ###############################################################################
 
@@ -35,6 +44,14 @@ class BaseService(object):
         """ save one item into database """
         return save_item(obj)
 
+    def save_items(self, objs):
+        """ save many new items into database, return saved count and failed batches """
+        return save_items(objs)
+
+    def upsert_items(self, objs, index_elements):
+        """ insert or update many items by unique attributes, return written count and failed batches """
+        return upsert_items(objs, index_elements)
+
     def count(self):
         return self.klass.query.count()
 
@@ -51,9 +68,35 @@ class BaseService(object):
         return obj.id if obj else None
 
     def execute_read_sql(self, clause, params=None):
-        """ execute SQL statement to read data from database """
+        """ execute SQL statement to read data from database, replicas if any
+
+        Anything but a SELECT statement is sent to the primary.
+        """
+
+        session = self.klass.query.session
+        if not is_read_clause(clause):
+            mark_writes(session)
+            return session.execute(clause, params)
+        return session.execute(clause, params, bind=get_read_bind(session))
+
+    def execute_write_sql(self, clause, params=None):
+        """ execute SQL statement to write data into the primary database """
+
+        session = self.klass.query.session
+        mark_writes(session)
+        return session.execute(clause, params)
 
-        return self.klass.query.session.execute(clause, params)
+
+# cache of compiled queries on hot paths
+bakery = baked.bakery()
+
+
+def unwrap_user(user_info):
+    """ get the real object behind flask_login.current_user """
+
+    if isinstance(user_info, LocalProxy):
+        return user_info._get_current_object()
+    return user_info
 
 
 class UserService(BaseService):
@@ -63,39 +106,64 @@ class UserService(BaseService):
     def load_user(self, user_id):
         """ load user information by id """
         if user_id is not None:
-            return self.klass.query.filter(self.klass.email == user_id).first()
+            # it runs on every page request, so the query with joined roles is
+            # compiled only once. Email is unique, and without LIMIT the roles
+            # are simply joined instead of wrapping the user query into a subquery.
+            # It's read from the primary, cached identities must not lag, and
+            # the user may be already loaded from a replica in this session.
+            query = bakery(lambda session: session.query(UserModel))
+            query += lambda q: q.filter(UserModel.email == bindparam('email')).populate_existing()
+            with reading_primary(self.klass.query.session) as session:
+                return query(session).params(email=user_id).one_or_none()
 
     def load_raw_user(self, user_info):
         """ load valid user information by user information """
-        if hasattr(user_info, 'authenticated'):
+        user_info = unwrap_user(user_info)
+        if isinstance(user_info, UserIdentity):
+            return self.klass.query.get(user_info.id)
+        elif hasattr(user_info, 'authenticated'):
             return user_info
         elif isinstance(user_info, str):
             if user_info.find('@'):
                 return self.klass.query.filter(
                     self.klass.email == user_info
-                ).first()
+                ).one_or_none()
             return self.klass.query.filter(
                 self.klass.name == user_info
-            ).first()
+            ).one_or_none()
         elif isinstance(user_info, int):
             return self.klass.query.get(user_info)
         else:
             return None
 
-    def load_valid_user(self, user_info, password, include_inactive=False):
-        """ load valid user information and check password """
+    def load_valid_user(self, user_info, password, include_inactive=False, login_ip=None):
+        """ load valid user information and check password
+
+        The password will be rehashed and saved if its hash is outdated. It
+        raises LoginThrottled when there are too many failed logins from
+        login_ip or on the account, before the password is hashed. And it raises
+        PasswordHasherBusy when the password hashing pool is saturated.
+        """
+
+        throttle = get_login_throttle()
+        account = user_info.lower() if isinstance(user_info, str) else None
+        throttle.check(login_ip, account)
 
         user = self.load_raw_user(user_info)
         if user:
             from flask import current_app
             public_salt = current_app.config.get(
                 'SECURITY_PASSWORD_SALT', None)
-            if not user.verify_password(prepare_for_hash(
+            verified, updated = user.verify_and_update_password(prepare_for_hash(
                 password, public_salt, user.private_salt
-            )):
-                return None
-
-            return user if user.is_active or include_inactive else None
+            ))
+            if verified:
+                throttle.succeeded(login_ip, account)
+                if updated:
+                    self.save_item(user)
+                return user if user.is_active or include_inactive else None
+
+        throttle.failed(login_ip, account)
         return None
 
     def login_user(self, user_info, remember, login_ip, force=False):
@@ -105,10 +173,19 @@ class UserService(BaseService):
         if not user:
             return None
 
+        now = datetime.datetime.utcnow()
         user.authenticated = True
+        if self.is_write_behind():
+            # the authenticated flag must stay strictly consistent, and the
+            # row is not updated at all if it is set already
+            if not self.save_item(user):
+                return None
+            login_audit_buffer.add(user.id, (None, (now, login_ip), 1))
+            return login_user(user, remember=remember, force=force)
+
         user.last_login_at = user.current_login_at
         user.last_login_ip = user.current_login_ip
-        user.current_login_at = datetime.datetime.utcnow()
+        user.current_login_at = now
         user.current_login_ip = login_ip
         user.login_count = user.login_count + 1
 
@@ -116,14 +193,30 @@ class UserService(BaseService):
             return login_user(user, remember=remember, force=force)
         return None
 
+    def is_write_behind(self):
+        """ detect login audit fields are buffered in memory or not """
+
+        from flask import current_app
+        return current_app.config.get('LOGIN_AUDIT_WRITE_BEHIND', False)
+
     def logout_user(self, user):
+        from flask import session
+
+        user = unwrap_user(user)
+        user = self.load_raw_user(user) if isinstance(user, UserIdentity) else user
         if hasattr(user, 'authenticated'):
             user.authenticated = False
             if self.save_item(user):
+                forget_session_identity(session)
                 return logout_user()
         return None
 
     def register_user(self, name, email, password):
+        """ register a new user with an activation token
+
+        It raises PasswordHasherBusy when the password hashing pool is saturated.
+        """
+
         msg = ''
 
         # check complecity of password
@@ -229,15 +322,34 @@ class UserService(BaseService):
         if not user_info or not role:
             return False
 
-        # get user information
-        user = self.load_raw_user(user_info)
-        if user is None:
-            return False
+        role_names = self.get_role_names(user_info)
+        return bool(role_names) and (role.name if isinstance(role, RoleModel) else role) in role_names
 
-        if isinstance(role, str):
-            return role in (role.name for role in user.roles)
-        else:
-            return role in self.roles
+    def get_role_names(self, user_info):
+        """ get names of roles granted to the user from the permission cache """
+
+        # both models and identity snapshots know their emails
+        user_info = unwrap_user(user_info)
+        email = user_info if isinstance(user_info, str) and '@' in user_info else getattr(user_info, 'email', None)
+        if email is None:
+            user = self.load_raw_user(user_info)
+            if user is None:
+                return None
+            email = user.email
+
+        return get_role_names(email, self.load_role_names)
+
+    def load_role_names(self, email):
+        """ load names of roles granted to the user from the primary database """
+
+        query = bakery(lambda session: session.query(RoleModel.name).join(
+            RolesUsers, RolesUsers.role_id == RoleModel.id
+        ).join(
+            UserModel, UserModel.id == RolesUsers.user_id
+        ))
+        query += lambda q: q.filter(UserModel.email == bindparam('email'))
+        with reading_primary(self.klass.query.session) as session:
+            return frozenset(name for name, in query(session).params(email=email))
 
     def grant_role(self, user_info, role):
         """ grant particular role to current user """
@@ -285,13 +397,118 @@ class UserService(BaseService):
             return False
 
         row_count = RolesUsers.query.filter(
-            RolesUsers.id == role_info.id
-        ).delete()
+            RolesUsers.user_id == user.id,
+            RolesUsers.role_id == role_info.id
+        ).delete(synchronize_session=False)
         if not row_count or row_count <= 0:
             return False
 
+        # bulk deletes bypass the mapper events
+        RolesUsers.query.session.expire(user, ['roles'])
+        invalidate_identity_on_commit(RolesUsers.query.session, user.email)
+
         return True
 
+    # max number of users resolved or changed by one statement, keeps bound
+    # parameters below the limit of SQLite
+    BULK_CHUNK_SIZE = 500
+
+    def grant_roles(self, users, roles):
+        """ grant roles (names or ids) to users (emails or ids) in bulk
+
+        Pairs which exist already are skipped. It returns the number of
+        granted pairs (None if failed) and the error message about unknown
+        users or roles, which are ignored.
+        """
+
+        table = RolesUsers.__table__
+        user_table, role_table = UserModel.__table__, RoleModel.__table__
+
+        def statement(user_ids, role_ids):
+            exists_clause = exists().where(and_(
+                table.c.n_user_id == user_table.c.n_user_id,
+                table.c.n_role_id == role_table.c.n_role_id,
+            ))
+            return table.insert().from_select(
+                [table.c.n_user_id, table.c.n_role_id],
+                select([user_table.c.n_user_id, role_table.c.n_role_id]).where(and_(
+                    user_table.c.n_user_id.in_(user_ids),
+                    role_table.c.n_role_id.in_(role_ids),
+                    ~exists_clause,
+                ))
+            )
+
+        return self._change_roles(users, roles, statement)
+
+    def revoke_roles(self, users, roles):
+        """ revoke roles (names or ids) from users (emails or ids) in bulk
+
+        It returns the number of revoked pairs (None if failed) and the error
+        message about unknown users or roles, which are ignored.
+        """
+
+        table = RolesUsers.__table__
+
+        def statement(user_ids, role_ids):
+            return table.delete().where(and_(
+                table.c.n_user_id.in_(user_ids),
+                table.c.n_role_id.in_(role_ids),
+            ))
+
+        return self._change_roles(users, roles, statement)
+
+    def resolve_users(self, users):
+        """ resolve emails or ids of users, return {id: email} and unknown ones """
+
+        return self._resolve(self.klass.id, self.klass.email, users)
+
+    def resolve_roles(self, roles):
+        """ resolve names or ids of roles, return {id: name} and unknown ones """
+
+        return self._resolve(RoleModel.id, RoleModel.name, roles)
+
+    def _resolve(self, id_column, name_column, items):
+        # ids come as digit strings from the command line and JSON payloads
+        items = list(dict.fromkeys(
+            int(item) if isinstance(item, str) and item.isdigit() else item for item in items
+        ))
+        found = {}
+        for idx in range(0, len(items), self.BULK_CHUNK_SIZE):
+            chunk = items[idx:idx + self.BULK_CHUNK_SIZE]
+            names = [item for item in chunk if isinstance(item, str)]
+            ids = [item for item in chunk if isinstance(item, int)]
+            conditions = ([name_column.in_(names)] if names else []) + ([id_column.in_(ids)] if ids else [])
+            if conditions:
+                found.update(self.klass.query.session.query(id_column, name_column).filter(or_(*conditions)))
+
+        known = set(found) | set(found.values())
+        return found, [item for item in items if item not in known]
+
+    def _change_roles(self, users, roles, statement):
+        found_users, unknown_users = self.resolve_users(users)
+        found_roles, unknown_roles = self.resolve_roles(roles)
+        unknown = unknown_users + unknown_roles
+        error = _('Unknown users or roles: {}').format(', '.join(map(str, unknown))) if unknown else ''
+        if not found_users or not found_roles:
+            return 0, error
+
+        session = self.klass.query.session
+        user_ids, role_ids = list(found_users), list(found_roles)
+        row_count = 0
+        try:
+            with db_trasaction():
+                for idx in range(0, len(user_ids), self.BULK_CHUNK_SIZE):
+                    row_count += session.execute(statement(
+                        user_ids[idx:idx + self.BULK_CHUNK_SIZE], role_ids
+                    )).rowcount
+
+                # bulk statements bypass the mapper events
+                if row_count:
+                    invalidate_identity_on_commit(session, *found_users.values())
+        except SQLAlchemyError:
+            return None, _('Failed to change roles of users')
+        return row_count, error
+
 
 class TokenService(BaseService):
     # user configuration token
@@ -303,6 +520,10 @@ class TokenService(BaseService):
     # JWT refresh token
     TOKEN_JWT_REFRESH = 2
 
+    # life time of JWT tokens (in seconds)
+    ACCESS_TOKEN_DURATION = 115 * 60
+    REFRESH_TOKEN_DURATION = 30 * 24 * 60 * 60
+
     def __init__(self):
         self.klass = TokenModel
 
@@ -319,7 +540,8 @@ class TokenService(BaseService):
 
         # generate token
         if category == self.TOKEN_JWT_ACCESS or category == self.TOKEN_JWT_REFRESH:
-            token.token = encode_jwt_token(user_id, duration, random_seed)
+            token.token = encode_jwt_token(
+                user_id, duration, random_seed, category)
         else:
             token.token = generate_random_salt(128)
 
@@ -329,25 +551,28 @@ class TokenService(BaseService):
 
     def get_last_one(self, category, owner_id):
         """ get last available token """
-        from sqlalchemy import and_, desc
 
         now = datetime.datetime.utcnow()
-        return self.klass.query.filter(and_(
+        return self.klass.query.filter(
             self.klass.category == category,
             self.klass.owner_id == owner_id,
             self.klass.create_on <= now,
-            now < self.klass.expiry_on
-        )).order_by(desc(self.klass.create_on)).first()
+            self.klass.expiry_on > now
+        ).order_by(self.klass.create_on.desc()).first()
 
-    def verify(self, category, owner_id, token):
+    def verify(self, category, owner_id, token, track_access=True):
         """
             verify provided token and retrieve the account counte.
             It will return the token object if token is valid, otherwise return None.
+            The access statistics will not be updated if track_access is False.
         """
 
         if not token:
             return None, _('Invalid token')
 
+        if category == self.TOKEN_JWT_ACCESS and self.is_stateless():
+            return self.verify_stateless(category, owner_id, token)
+
         if owner_id is None and category in [self.TOKEN_JWT_ACCESS, self.TOKEN_JWT_REFRESH]:
             # decode owner_id from provided token
             payload, msg = decode_jwt_token(token)
@@ -359,12 +584,18 @@ class TokenService(BaseService):
 
         # retrieve stored token and check with provided one
         stored_token = self.get_last_one(category, owner_id)
-        act_token = stored_token.token if stored_token else ''
-        if isinstance(act_token, bytes):
-            act_token = act_token.decode('utf-8')
-        if stored_token and act_token == token:
+        if stored_token and hmac.compare_digest(stored_token.token_hash, hash_token(token)):
+            stored_token.token = token
+            if not track_access:
+                return stored_token, ''
+
             now = datetime.datetime.utcnow()
 
+            # single-use tokens must stay strictly consistent
+            if category != self.TOKEN_USER_ACTIVATION and self.is_write_behind():
+                token_stats_buffer.add(stored_token.id, (now, now, 1))
+                return stored_token, ''
+
             if stored_token.first_access_on is None:
                 stored_token.first_access_on = now
             stored_token.last_access_on = now
@@ -373,33 +604,210 @@ class TokenService(BaseService):
                 return stored_token, ''
         return None, _('Invalid or expired token')
 
+    def is_write_behind(self):
+        """ detect access statistics are buffered in memory or not """
+
+        from flask import current_app
+        return current_app.config.get('TOKEN_STATS_WRITE_BEHIND', False)
+
+    def is_stateless(self):
+        """ detect access tokens are verified without touching database or not """
+
+        from flask import current_app
+        return current_app.config.get('TOKEN_STATELESS_VERIFY', False)
+
+    def verify_stateless(self, category, owner_id, token):
+        """
+            verify provided token by its signature, expiry date and the denylist only.
+            It will return a transient token object if token is valid, otherwise return None.
+        """
+
+        payload, msg = decode_jwt_token(token)
+        if not payload or 'uid' not in payload:
+            return None, msg or _('Invalid or expired token')
+
+        uid = int(payload['uid'])
+        random_seed = payload.get('rds', 0)
+        if payload.get('cat') != category or (owner_id is not None and owner_id != uid):
+            return None, _('Invalid or expired token')
+
+        denylist = get_token_denylist()
+        if denylist.is_revoked(hash_token(token)) or \
+                denylist.is_revoked(self.pair_digest(uid, random_seed)):
+            return None, _('Invalid or expired token')
+
+        return self.klass(
+            category=category,
+            owner_id=uid,
+            token=token,
+            random_seed=random_seed,
+            access_count=0,
+            create_on=datetime.datetime.utcfromtimestamp(payload['iat']),
+            expiry_on=datetime.datetime.utcfromtimestamp(payload['exp']),
+        ), ''
+
+    def pair_digest(self, owner_id, random_seed):
+        """ get the denylist key of the access/refresh token pair """
+        return hash_token('{}:{}'.format(owner_id, random_seed))
+
     def purge(self, category, owner_id, token):
         """ purge current access token if any valid token has been provided """
 
+        # the token may be still alive in stateless mode, so deny it explicitly
+        jwt_payload_cache.invalidate(hash_token(token))
+        if category == self.TOKEN_JWT_ACCESS:
+            get_token_denylist().revoke(
+                hash_token(token),
+                datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ACCESS_TOKEN_DURATION)
+            )
+
         result = False
         with db_trasaction():
             if self.klass.query.filter(
                 self.klass.category == category,
                 self.klass.owner_id == owner_id,
-                self.klass.token == token
+                self.klass.token_hash == hash_token(token)
             ).delete() == 1:
                 result = True
         return result
 
+    def purge_expired(self, chunk_size=1000):
+        """ purge expired tokens chunk by chunk, return purged rows and elapsed seconds """
+
+        start = time.perf_counter()
+        now = datetime.datetime.utcnow()
+
+        result = 0
+        while True:
+            # commit each chunk separately to avoid holding locks for long
+            token_ids = [row.id for row in self.klass.query.with_entities(
+                self.klass.id
+            ).filter(self.klass.expiry_on <= now).limit(chunk_size)]
+            if not token_ids:
+                break
+
+            with db_trasaction():
+                result += self.klass.query.filter(
+                    self.klass.id.in_(token_ids)
+                ).delete(synchronize_session=False)
+
+        elapsed = time.perf_counter() - start
+
+        from flask import current_app
+        current_app.logger.info('{} expired tokens purged in {:.3f} seconds'.format(
+            result, elapsed
+        ))
+        return result, elapsed
+
     def generate_auth_tokens(self, user_id):
         """ generate access token and refresh token """
 
-        # generate random integer as the pair refference
-        random.seed(datetime.datetime.utcnow())
-        random_seed = random.randint(0, 65535)
+        # only the latest access token is valid, so deny the previous one in stateless mode
+        if self.is_stateless():
+            last_token = self.get_last_one(self.TOKEN_JWT_ACCESS, user_id)
+            if last_token:
+                get_token_denylist().revoke(
+                    last_token.token_hash, last_token.expiry_on
+                )
 
-        access_token = self.create(
-            self.TOKEN_JWT_ACCESS, user_id, 115 * 60, random_seed
-        )
-        refresh_token = self.create(
-            self.TOKEN_JWT_REFRESH, user_id, 30 * 24 * 60 * 60, random_seed
+        try:
+            with db_trasaction():
+                access_token, refresh_token = self.insert_auth_tokens(
+                    user_id, self.pair_seed()
+                )
+        except Exception:
+            access_token = refresh_token = None
+        return access_token, refresh_token
+
+    def pair_seed(self):
+        """ generate random integer as the pair refference """
+
+        # never reseed the global random generator, which is shared by all threads
+        return secrets.randbelow(65536)
+
+    def insert_auth_tokens(self, user_id, random_seed):
+        """ insert access token and refresh token in one statement """
+
+        now = datetime.datetime.utcnow()
+        tokens = []
+        rows = []
+        for category, duration in [
+            (self.TOKEN_JWT_ACCESS, self.ACCESS_TOKEN_DURATION),
+            (self.TOKEN_JWT_REFRESH, self.REFRESH_TOKEN_DURATION),
+        ]:
+            token = encode_jwt_token(user_id, duration, random_seed, category)
+            tokens.append(token)
+            rows.append({
+                'd_create': now,
+                'd_expiry': now + datetime.timedelta(seconds=duration),
+                'n_access_count': 0,
+                'n_category': category,
+                'c_token_hash': hash_token(token),
+                'n_random_seed': random_seed,
+                'n_owner_id': user_id,
+            })
+        self.klass.query.session.execute(self.klass.__table__.insert().values(rows))
+        return tokens[0], tokens[1]
+
+    def refresh_auth_tokens(self, refresh_token):
+        """
+            re-generate access token and refresh token by provided refresh token.
+            The whole pipeline(one verify, two deletes and one multi-row insert)
+            will be committed as one transaction.
+        """
+
+        msg = ''
+        access_token = new_refresh_token = None
+        try:
+            with db_trasaction() as txn:
+                # verify refresh token
+                token, msg = self.verify(
+                    self.TOKEN_JWT_REFRESH, None, refresh_token, track_access=False
+                )
+                txn.try_assert(
+                    token is None or token.access_count is None,
+                    msg or _('Invalid or expired refresh token')
+                )
+                owner_id = token.owner_id
+                random_seed = token.random_seed
+
+                # redeem the refresh token, only one of concurrent refreshes deletes it
+                txn.try_assert(
+                    self.klass.query.filter(
+                        self.klass.owner_id == owner_id,
+                        self.klass.category == self.TOKEN_JWT_REFRESH,
+                        self.klass.token_hash == hash_token(refresh_token)
+                    ).delete(synchronize_session=False) != 1,
+                    _('Invalid or expired refresh token')
+                )
+
+                # purge the access token of the pair
+                self.klass.query.filter(
+                    self.klass.owner_id == owner_id,
+                    self.klass.category == self.TOKEN_JWT_ACCESS,
+                    self.klass.random_seed == random_seed
+                ).delete(synchronize_session=False)
+
+                # re-generate refresh token and access token
+                access_token, new_refresh_token = self.insert_auth_tokens(
+                    owner_id, self.pair_seed()
+                )
+
+            # revoke the old pair only when the new one is committed
+            self.deny_auth_tokens(owner_id, random_seed, refresh_token)
+        except Exception as exp:
+            msg = str(exp)
+            access_token = new_refresh_token = None
+        return access_token, new_refresh_token, msg
+
+    def deny_auth_tokens(self, owner_id, random_seed, refresh_token):
+        """ deny the token pair in caches, the access token may be still alive in stateless mode """
+
+        jwt_payload_cache.invalidate(hash_token(refresh_token))
+        get_token_denylist().revoke(
+            self.pair_digest(owner_id, random_seed),
+            datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ACCESS_TOKEN_DURATION)
         )
-        return access_token.token if access_token else None, refresh_token.token if refresh_token else None
 
     def purge_auth_tokens(self, token):
         """ purge access token and refresh token """
@@ -414,13 +822,15 @@ class TokenService(BaseService):
         random_seed = token.random_seed
         owner_id = token.owner_id
 
+        self.deny_auth_tokens(owner_id, random_seed, token.token)
+
         result = True
         with db_trasaction():
             # purge refresh token
             if self.klass.query.filter(
                 self.klass.category == self.TOKEN_JWT_REFRESH,
                 self.klass.owner_id == owner_id,
-                self.klass.token == token.token
+                self.klass.token_hash == token.token_hash
             ).delete() != 1:
                 result = False
 
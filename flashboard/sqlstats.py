@@ -0,0 +1,138 @@
+""" sqlstats.py
+    Per-request SQL instrumentation: statements and database time of each
+    request are counted by engine events, and statements slower than a
+    threshold are written to the slow-query log with the endpoint issuing them.
+"""
+
+import time
+import logging
+import threading
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+slow_query_log = logging.getLogger('flashboard.slow_query')
+
+# statements slower than so many seconds are logged (None to disable)
+slow_query_threshold = None
+###############################################################################
+
+
+class SqlStats(object):
+    """ aggregate statements and database time of requests per endpoint """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, statements, db_time, slow_queries):
+        """ record the totals of one request """
+
+        with self._lock:
+            item = self._endpoints.get(endpoint)
+            if item is None:
+                item = self._endpoints[endpoint] = {
+                    'requests': 0,
+                    'statements': 0,
+                    'db_time': 0.0,
+                    'max_statements': 0,
+                    'max_db_time': 0.0,
+                    'slow_queries': 0,
+                }
+            item['requests'] += 1
+            item['statements'] += statements
+            item['db_time'] += db_time
+            item['max_statements'] = max(item['max_statements'], statements)
+            item['max_db_time'] = max(item['max_db_time'], db_time)
+            item['slow_queries'] += slow_queries
+
+    def snapshot(self):
+        """ get a copy of the totals keyed by endpoint, with averages per request """
+
+        with self._lock:
+            stats = {endpoint: dict(item) for endpoint, item in self._endpoints.items()}
+        for item in stats.values():
+            item['avg_statements'] = item['statements'] / item['requests']
+            item['avg_db_time'] = item['db_time'] / item['requests']
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+# totals of all requests served by current worker
+sql_stats = SqlStats()
+
+
+def get_request_stats():
+    """ get [statements, database time, slow queries] of current request, or
+    None outside of requests or when SQL_STATS is disabled
+    """
+
+    if not has_request_context():
+        return None
+    return g.get('sql_stats', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # statements of one connection never overlap, a failed one is overwritten
+    conn.info['query_start'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start']
+
+    slow = slow_query_threshold is not None and elapsed >= slow_query_threshold
+    if slow:
+        slow_query_log.warning('{:.1f} ms [{}] {}'.format(
+            elapsed * 1000.0, request.endpoint if has_request_context() else '-', statement
+        ))
+
+    totals = get_request_stats()
+    if totals is not None:
+        totals[0] += 1
+        totals[1] += elapsed
+        totals[2] += slow
+
+
+def init_sqlstats(app):
+    """ count statements and database time of each request of application
+
+    Statements of all engines are timed, those slower than
+    SLOW_QUERY_THRESHOLD seconds go to the `flashboard.slow_query` logger.
+    The totals of each request are recorded in sql_stats, and sent in the
+    X-DB-Statements and X-DB-Time (in ms) headers if SQL_STATS_HEADER is set.
+
+    It must be called before init_db, so the totals are recorded after the
+    teardown of the session has flushed pending writes.
+    """
+
+    global slow_query_threshold
+
+    if not app.config.get('SQL_STATS', True):
+        return
+
+    slow_query_threshold = app.config.get('SLOW_QUERY_THRESHOLD', None)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_sql_stats():
+        g.sql_stats = [0, 0.0, 0]
+
+    @app.after_request
+    def add_sql_stats_header(response):
+        totals = get_request_stats()
+        if totals is not None and app.config.get('SQL_STATS_HEADER', False):
+            response.headers['X-DB-Statements'] = str(totals[0])
+            response.headers['X-DB-Time'] = '{:.3f}'.format(totals[1] * 1000.0)
+        return response
+
+    @app.teardown_request
+    def record_sql_stats(exception=None):
+        totals = get_request_stats()
+        if totals is not None:
+            sql_stats.add(request.endpoint or '-', *totals)
@@ -0,0 +1,214 @@
+""" throttle.py
+    Throttling of failed logins per IP and per account, so a credential
+    stuffing burst is rejected before any password hashing happens.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from .cache import get_local_store
+###############################################################################
+
+
+class LoginThrottled(Exception):
+    """ raised when there are too many failed logins from an IP or on an account """
+    pass
+
+
+class SlidingWindowCounter(object):
+    """ in-process sliding window counter of hits per key
+
+    Hits are counted in fixed windows, and the count of the last `window`
+    seconds is estimated from the current and previous window weighted by
+    their overlap. At most `max_keys` keys are kept, the least recently used
+    one will be evicted.
+    """
+
+    def __init__(self, window=300, max_keys=100000):
+        self.window = window
+        self.max_keys = max_keys
+
+        # entries are (window index, hits in current window, hits in previous window)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def count(self, key, now=None):
+        """ estimate hits of key in the last window """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+        return self._estimate(entry, now) if entry else 0.0
+
+    def hit(self, key, now=None):
+        """ count one hit of key """
+
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        with self._lock:
+            slot, current, previous = self._entries.pop(key, (index, 0, 0))
+            if slot != index:
+                current, previous = 0, current if slot == index - 1 else 0
+            self._entries[key] = (index, current + 1, previous)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _estimate(self, entry, now):
+        index, elapsed = divmod(now, self.window)
+        slot, current, previous = entry
+        if slot == index:
+            return current + previous * (1.0 - elapsed / self.window)
+        elif slot == index - 1:
+            return current * (1.0 - elapsed / self.window)
+        return 0.0
+
+
+class SharedSlidingWindowCounter(SlidingWindowCounter):
+    """ sliding window counter shared by all workers through a LocalStore
+
+    Hits are written into the store one row per key and window, rows of old
+    windows are pruned every `prune_every` hits.
+    """
+
+    def __init__(self, store, window=300, prune_every=1024):
+        super().__init__(window)
+        self.store = store
+        self.prune_every = prune_every
+        self._hit_count = 0
+
+        self.store.execute(
+            'CREATE TABLE IF NOT EXISTS login_throttle ('
+            '  key TEXT NOT NULL,'
+            '  slot INTEGER NOT NULL,'
+            '  hits INTEGER NOT NULL,'
+            '  PRIMARY KEY (key, slot)'
+            ')'
+        )
+
+    def __len__(self):
+        return self.store.execute('SELECT COUNT(DISTINCT key) FROM login_throttle')[0][0]
+
+    def count(self, key, now=None):
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        rows = self.store.execute(
+            'SELECT slot, hits FROM login_throttle WHERE key = ? AND slot >= ?',
+            (key, index - 1)
+        )
+        hits = dict(rows)
+        return self._estimate((index, hits.get(index, 0), hits.get(index - 1, 0)), now)
+
+    def hit(self, key, now=None):
+        now = time.time() if now is None else now
+        index = int(now // self.window)
+        self.store.execute(
+            'INSERT INTO login_throttle(key, slot, hits) VALUES(?, ?, 1) '
+            'ON CONFLICT(key, slot) DO UPDATE SET hits = hits + 1',
+            (key, index)
+        )
+
+        self._hit_count += 1
+        if self._hit_count % self.prune_every == 0:
+            self.store.execute('DELETE FROM login_throttle WHERE slot < ?', (index - 1,))
+
+    def reset(self, key):
+        self.store.execute('DELETE FROM login_throttle WHERE key = ?', (key,))
+
+    def clear(self):
+        self.store.execute('DELETE FROM login_throttle')
+
+
+class LoginThrottle(object):
+    """ reject logins from an IP or on an account with too many recent failures
+
+    A limit of 0 disables the relevant check.
+    """
+
+    def __init__(self, counter=None, ip_limit=0, account_limit=0):
+        self.counter = counter or SlidingWindowCounter()
+        self.ip_limit = ip_limit
+        self.account_limit = account_limit
+
+        # statistics
+        self.checked = 0
+        self.rejected = 0
+        self.failures = 0
+
+    def check(self, login_ip, account):
+        """ raise LoginThrottled if the login should be rejected """
+
+        self.checked += 1
+        if self._exceeded('ip:', login_ip, self.ip_limit) or \
+                self._exceeded('account:', account, self.account_limit):
+            self.rejected += 1
+            raise LoginThrottled('Too many failed logins, please try again later')
+
+    def failed(self, login_ip, account):
+        """ record one failed login """
+
+        self.failures += 1
+        if login_ip and self.ip_limit > 0:
+            self.counter.hit('ip:' + login_ip)
+        if account and self.account_limit > 0:
+            self.counter.hit('account:' + account)
+
+    def succeeded(self, login_ip, account):
+        """ forget failed logins on the account """
+
+        if account and self.account_limit > 0:
+            self.counter.reset('account:' + account)
+
+    def stats(self):
+        return {
+            'keys': len(self.counter),
+            'checked': self.checked,
+            'rejected': self.rejected,
+            'failures': self.failures,
+        }
+
+    def _exceeded(self, prefix, key, limit):
+        return bool(key) and limit > 0 and self.counter.count(prefix + key) >= limit
+
+
+# throttle of failed logins, disabled by default
+login_throttle = LoginThrottle()
+
+
+def get_login_throttle():
+    """ get the throttle of failed logins """
+    return login_throttle
+
+
+def init_throttle(app):
+    """ initialize the throttle of failed logins for current application
+
+    Failed logins will be counted across all workers if LOGIN_THROTTLE_DB is
+    provided.
+    """
+
+    global login_throttle
+
+    window = app.config.get('LOGIN_THROTTLE_WINDOW', 300)
+    path = app.config.get('LOGIN_THROTTLE_DB', None)
+    if path:
+        counter = SharedSlidingWindowCounter(get_local_store(path), window)
+    else:
+        counter = SlidingWindowCounter(window, app.config.get('LOGIN_THROTTLE_MAX_KEYS', 100000))
+
+    login_throttle = LoginThrottle(
+        counter,
+        app.config.get('LOGIN_THROTTLE_IP_LIMIT', 0),
+        app.config.get('LOGIN_THROTTLE_ACCOUNT_LIMIT', 0),
+    )
@@ -1,6 +1,7 @@
 import os
 import sys
 import base64
+import hashlib
 import jwt
 import datetime
 from string import ascii_lowercase, ascii_uppercase, digits
@@ -8,6 +9,8 @@ from string import ascii_lowercase, ascii_uppercase, digits
 from flask import current_app, request
 from flask_babel import gettext as _
 
+from .cache import jwt_payload_cache
+
 PYTHON2 = sys.version_info < (3, 0)
 ###############################################################################
 
@@ -91,7 +94,15 @@ def strip_space_lower(data):
     return data.strip().lower() if data else None
 
 
-def encode_jwt_token(user_id, duration, random_seed=0):
+def hash_token(token):
+    """ get the fixed-size (32 bytes) digest of the provided token """
+
+    if isinstance(token, str):
+        token = token.encode('utf-8')
+    return hashlib.sha256(token).digest()
+
+
+def encode_jwt_token(user_id, duration, random_seed=0, category=None):
     """ generate JWT token
 
     The JWT Token's payload contain:
@@ -99,6 +110,7 @@ def encode_jwt_token(user_id, duration, random_seed=0):
         'exp' (expiration date of the token),
         'iat' (the time the token is generated),
         'rds' (random seed),
+        'cat' (token category),
     """
 
     now = datetime.datetime.utcnow()
@@ -107,7 +119,8 @@ def encode_jwt_token(user_id, duration, random_seed=0):
             'uid': user_id,
             'exp': now + datetime.timedelta(seconds=duration),
             'iat': now,
-            'rds': random_seed
+            'rds': random_seed,
+            'cat': category
         },
         current_app.config.get('SECRET_KEY', ''),
         algorithm='HS512'
@@ -115,9 +128,17 @@ def encode_jwt_token(user_id, duration, random_seed=0):
 
 
 def decode_jwt_token(token):
-    """ verify JWT token """
+    """ verify JWT token
+
+    Verified payloads are cached until the token itself is expired, so the
+    same token will not be verified again and again.
+    """
+
+    digest = hash_token(token) if token else None
+    payload = jwt_payload_cache.get(digest) if digest else None
+    if payload is not None:
+        return dict(payload), ''
 
-    payload = None
     msg = ''
 
     try:
@@ -133,6 +154,9 @@ def decode_jwt_token(token):
     except Exception as exp:
         msg = str(exp)
 
+    if payload and digest and 'exp' in payload:
+        jwt_payload_cache.set(digest, dict(payload), payload['exp'])
+
     return payload, msg
 
 
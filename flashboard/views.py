@@ -7,8 +7,11 @@ from flask_babel import gettext as _
 from config.config import all_urls
 from .forms import LoginForm, SignupForm
 from .services import UserService
+from .hashing import PasswordHasherBusy
+from .throttle import LoginThrottled
 from .app import login_manager, send_email, allow_inactive_login, get_menu_list
 from .rbac import rbac_module
+from .database import read_only
 
 bp = Blueprint('flashboard', __name__, template_folder='templates')
 ###############################################################################
@@ -31,16 +34,22 @@ def login():
 
         # special process for confirm_email
         include_inactive = allow_inactive_login(next)
-        user = usvc.load_valid_user(email, password, include_inactive)
-        login_ip = request.environ.get(
-            'HTTP_X_REAL_IP', request.remote_addr
-        )
+        login_ip = request.remote_addr
+        msg = _('Invalid username or password or inactive user')
+        try:
+            user = usvc.load_valid_user(email, password, include_inactive, login_ip)
+        except LoginThrottled:
+            user = None
+            msg = _('Too many failed logins, please try again later')
+        except PasswordHasherBusy:
+            user = None
+            msg = _('Server is busy, please try again later')
 
         # update user login information
         if user and usvc.login_user(user, remember=remember_me, login_ip=login_ip, force=include_inactive):
             return redirect(next or url_for(all_urls['home']))
         else:
-            flash(_('Invalid username or password or inactive user'), 'error')
+            flash(msg, 'error')
             # return redirect(next or url_for(all_urls['login']))
     return render_template(
         'login.html',
@@ -67,7 +76,10 @@ def signup():
 
         if password and password2 and password == password2:
             usvc = UserService()
-            user, token, error = usvc.register_user(name, email, password)
+            try:
+                user, token, error = usvc.register_user(name, email, password)
+            except PasswordHasherBusy:
+                user, token, error = None, None, _('Server is busy, please try again later')
             if user and token:
                 # triger activation email
                 confirm_url = login_url(
@@ -139,6 +151,7 @@ def logout():
 
 
 @bp.route('/home', methods=['GET'])
+@read_only
 @rbac_module('home')
 def home():
     if current_user.is_authenticated:
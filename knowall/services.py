@@ -201,5 +201,5 @@ class ColumnService(BaseService):
                 src_table=src_table,
                 creator_id=creator_id,
             )
-        rst = self.execute_read_sql(clause)
+        rst = self.execute_write_sql(clause)
         return True if rst else False
@@ -5,6 +5,7 @@ from flask_login import current_user, login_required
 from flask_babel import gettext as _
 
 from flashboard.app import get_menu_list
+from flashboard.database import read_only
 from .services import ProjectService, TableService, ColumnService
 from .models import EnumLogicType
 
@@ -27,7 +28,7 @@ def init_view(app, url_prefix):
 
     # defin all view class
     class ProjectListView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self):
             projects = ProjectService().get_list(current_user.id)
@@ -38,7 +39,7 @@ def init_view(app, url_prefix):
             )
 
     class ProjectDetailView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self, proj_id=None):
             proj_info = False
@@ -54,7 +55,7 @@ def init_view(app, url_prefix):
             )
 
     class TableListView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self):
             tables = TableService().get_list(current_user.id)
@@ -65,7 +66,7 @@ def init_view(app, url_prefix):
             )
 
     class TableDetailView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self, table_name=''):
             table_info = False
@@ -83,7 +84,7 @@ def init_view(app, url_prefix):
             )
 
     class ColumnListView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self, table_name=''):
             columns = False
@@ -101,7 +102,7 @@ def init_view(app, url_prefix):
             )
 
     class ColumnDetailView(MethodView):
-        decorators = [login_required]
+        decorators = [login_required, read_only]
 
         def get(self, table_name='', col_name=''):
             col_info = False
@@ -8,6 +8,7 @@ from flask_babel import lazy_gettext as _
 
 from flashboard.app import create_app, enable_celery, add_menu_items
 from flashboard.database import create_all_tables
+from flashboard.services import TokenService, UserService
 from flashboard.utils import get_all_routes
 
 from knowall.views import init_view
@@ -59,6 +60,55 @@ if app.config.get('ENV', None) == 'development':
             add_metadata_for_app(app)
 
 
+@manager.command
+def purge_tokens(chunk_size=0):
+    """ purge expired tokens from sys_token_mgr """
+
+    rows, elapsed = TokenService().purge_expired(
+        chunk_size or app.config.get('TOKEN_PURGE_CHUNK_SIZE', 1000)
+    )
+    print('{} expired tokens purged in {:.3f} seconds'.format(rows, elapsed))
+
+
+def split_items(value):
+    """ split comma separated items, or read one item per line from @file """
+
+    if value.startswith('@'):
+        with open(value[1:]) as fp:
+            return [line.strip() for line in fp if line.strip()]
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+@manager.command
+def grant_roles(users, roles):
+    """ grant roles to users in bulk, both are comma separated or @file """
+
+    count, error = UserService().grant_roles(split_items(users), split_items(roles))
+    if error:
+        print(error)
+    if count is not None:
+        print('{} roles granted'.format(count))
+
+
+@manager.command
+def revoke_roles(users, roles):
+    """ revoke roles from users in bulk, both are comma separated or @file """
+
+    count, error = UserService().revoke_roles(split_items(users), split_items(roles))
+    if error:
+        print(error)
+    if count is not None:
+        print('{} roles revoked'.format(count))
+
+
+@celery.task()
+def purge_expired_tokens():
+    rows, elapsed = TokenService().purge_expired(
+        app.config.get('TOKEN_PURGE_CHUNK_SIZE', 1000)
+    )
+    return {'rows': rows, 'elapsed': elapsed}
+
+
 @celery.task()
 def add_together(a, b):
     return a + b
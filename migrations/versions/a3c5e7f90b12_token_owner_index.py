@@ -0,0 +1,28 @@
+"""add covering index for token lookup
+
+Revision ID: a3c5e7f90b12
+Revises: 1fee8919d2fa
+Create Date: 2026-10-18 09:12:40.412093
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c5e7f90b12'
+down_revision = '1fee8919d2fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_token_mgr_owner',
+        'sys_token_mgr',
+        ['n_category', 'n_owner_id', 'd_create', 'd_expiry'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('ix_token_mgr_owner', table_name='sys_token_mgr')
@@ -0,0 +1,28 @@
+"""add index for purging expired tokens
+
+Revision ID: c81d2e4f6a35
+Revises: a3c5e7f90b12
+Create Date: 2026-10-18 10:05:13.228741
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81d2e4f6a35'
+down_revision = 'a3c5e7f90b12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f('ix_sys_token_mgr_d_expiry'),
+        'sys_token_mgr',
+        ['d_expiry'],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_sys_token_mgr_d_expiry'), table_name='sys_token_mgr')
@@ -0,0 +1,87 @@
+"""store the digest of tokens instead of the tokens
+
+Revision ID: e4b9d1a7c203
+Revises: c81d2e4f6a35
+Create Date: 2026-10-18 11:26:02.507316
+
+"""
+import hashlib
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b9d1a7c203'
+down_revision = 'c81d2e4f6a35'
+branch_labels = None
+depends_on = None
+
+# backfill rows chunk by chunk
+CHUNK_SIZE = 1000
+
+token_mgr = sa.table(
+    'sys_token_mgr',
+    sa.column('n_token_id', sa.Integer()),
+    sa.column('c_token', sa.String(256)),
+    sa.column('c_token_hash', sa.LargeBinary(32)),
+)
+
+
+def upgrade():
+    with op.batch_alter_table('sys_token_mgr') as batch_op:
+        batch_op.add_column(sa.Column(
+            'c_token_hash', sa.LargeBinary(length=32), nullable=True, comment='SHA-256 digest of token'
+        ))
+
+    # backfill digest of existing tokens
+    conn = op.get_bind()
+    stmt = token_mgr.update().where(
+        token_mgr.c.n_token_id == sa.bindparam('b_id')
+    ).values(c_token_hash=sa.bindparam('b_hash'))
+
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            sa.select([token_mgr.c.n_token_id, token_mgr.c.c_token]).where(
+                token_mgr.c.n_token_id > last_id
+            ).order_by(token_mgr.c.n_token_id).limit(CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+
+        conn.execute(stmt, [{
+            'b_id': row[0],
+            'b_hash': hashlib.sha256(row[1].encode('utf-8')).digest(),
+        } for row in rows])
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table('sys_token_mgr') as batch_op:
+        batch_op.alter_column('c_token_hash', existing_type=sa.LargeBinary(length=32), nullable=False)
+        batch_op.create_index('ix_sys_token_mgr_c_token_hash', ['c_token_hash'], unique=True)
+        batch_op.drop_column('c_token')
+
+
+def downgrade():
+    with op.batch_alter_table('sys_token_mgr') as batch_op:
+        batch_op.add_column(sa.Column(
+            'c_token', sa.String(length=256), nullable=True, comment='Token'
+        ))
+
+    # tokens can not be recovered from their digest, so all of them will be
+    # invalid and users have to login again
+    conn = op.get_bind()
+    rows = conn.execute(sa.select([token_mgr.c.n_token_id, token_mgr.c.c_token_hash])).fetchall()
+    if rows:
+        conn.execute(token_mgr.update().where(
+            token_mgr.c.n_token_id == sa.bindparam('b_id')
+        ).values(c_token=sa.bindparam('b_token')), [{
+            'b_id': row[0],
+            'b_token': bytes(row[1]).hex(),
+        } for row in rows])
+
+    with op.batch_alter_table('sys_token_mgr') as batch_op:
+        batch_op.alter_column('c_token', existing_type=sa.String(length=256), nullable=False)
+        batch_op.create_unique_constraint('sys_token_mgr_c_token_key', ['c_token'])
+        batch_op.drop_index('ix_sys_token_mgr_c_token_hash')
+        batch_op.drop_column('c_token_hash')
@@ -102,6 +102,9 @@ class ApiProxy(object):
     api_url_logout = '/api/user/logout'
     api_url_refresh = '/api/user/refresh'
     api_url_register = '/api/user/register'
+    api_url_grant_roles = '/api/user/roles/grant'
+    api_url_revoke_roles = '/api/user/roles/revoke'
+    api_url_stats = '/api/user/stats'
 
     def __init__(self, client):
         self._client = client
@@ -133,8 +136,8 @@ class ApiProxy(object):
     #############################
     def login(self, email, password):
         return self._api_post(self.api_url_login, {
-            'email': 'luonbin@hotmail.com',
-            'password': 'Test001'
+            'email': email,
+            'password': password
         }, with_token=False)
 
     def logout(self):
@@ -152,6 +155,18 @@ class ApiProxy(object):
             'password': password,
         })
 
+    def grant_roles(self, users, roles):
+        return self._api_post(self.api_url_grant_roles, data={
+            'users': users,
+            'roles': roles,
+        })
+
+    def revoke_roles(self, users, roles):
+        return self._api_post(self.api_url_revoke_roles, data={
+            'users': users,
+            'roles': roles,
+        })
+
     #############################
     #
     # Helper functions here
@@ -1,4 +1,17 @@
-from flashboard.models import UserModel, RolesUsers
+import json
+import datetime
+
+from passlib.hash import sha512_crypt
+from sqlalchemy import event
+
+from flashboard import database
+from flashboard.buffers import token_stats_buffer, login_audit_buffer
+from flashboard.cache import get_token_denylist
+from flashboard.hashing import password_hasher, PasswordHasherBusy
+from flashboard.models import UserModel, RolesUsers, TokenModel
+from flashboard.services import TokenService, UserService
+from flashboard.throttle import init_throttle, get_login_throttle
+from flashboard.utils import decode_jwt_token, hash_token
 
 
 def test_login(client, api):
@@ -144,3 +157,331 @@ def test_register(client, api):
     finally:
         # normal logout
         api.assert_normal_action(api.logout())
+
+
+def test_stateless_verify(app, client, api):
+    app.config['TOKEN_STATELESS_VERIFY'] = True
+
+    try:
+        # normal login
+        access_token, refresh_token = api.assert_normal_login(
+            api.login('luonbin@hotmail.com', 'Test001')
+        )
+
+        ###########################################
+        #
+        # Core test cases start from here
+        #
+        ###########################################
+        # login after login
+        new_access_token, new_refresh_token = api.assert_normal_login(
+            api.login('luonbin@hotmail.com', 'Test001')
+        )
+
+        # logout with the old access token
+        api.access_token = access_token
+        api.assert_invalid_token(api.logout())
+
+        # refresh token pair, the access token of previous pair is denied
+        api.access_token, refresh_token = api.assert_normal_refresh(
+            api.refresh(new_refresh_token)
+        )
+        old_access_token, api.access_token = api.access_token, new_access_token
+        api.assert_invalid_token(api.logout())
+        api.access_token = old_access_token
+
+        # access token has been verified without touching sys_token_mgr
+        api.assert_invalid_register_exist(api.register(
+            'robin', 'luonbin@hotmail.com', 'Test001'
+        ))
+        token = TokenModel.query.filter(
+            TokenModel.token_hash == hash_token(api.access_token)
+        ).first()
+        assert token and token.access_count == 0 and token.last_access_on is None, \
+            'No access statistics in stateless mode'
+    finally:
+        # normal logout
+        api.assert_normal_action(api.logout())
+
+    # logout again after logout
+    api.assert_invalid_token(api.logout())
+
+
+def test_token_stats_write_behind(app, client, api):
+    app.config['TOKEN_STATS_WRITE_BEHIND'] = True
+
+    # normal login
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    def access_count():
+        return database.db_session.execute(
+            TokenModel.__table__.select().where(
+                TokenModel.__table__.c.c_token_hash == hash_token(api.access_token)
+            )
+        ).first()['n_access_count']
+
+    for _ in range(3):
+        api.assert_invalid_register_exist(api.register(
+            'robin', 'luonbin@hotmail.com', 'Test001'
+        ))
+    assert access_count() == 0, 'Access statistics are buffered in memory'
+
+    assert token_stats_buffer.flush() == 1, 'One token has been flushed'
+    assert access_count() == 3, 'Access statistics are flushed into database'
+
+    # normal logout
+    api.assert_normal_action(api.logout())
+
+
+def test_login_audit_write_behind(app, client, api):
+    app.config['LOGIN_AUDIT_WRITE_BEHIND'] = True
+
+    def audit():
+        table = UserModel.__table__
+        return database.db_session.execute(
+            table.select().where(table.c.c_email == 'luonbin@hotmail.com')
+        ).first()
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    login_audit_buffer.flush()
+    before = audit()
+
+    for _ in range(3):
+        api.access_token, refresh_token = api.assert_normal_login(
+            api.login('luonbin@hotmail.com', 'Test001')
+        )
+    pending = audit()
+    assert pending['b_authenticated'], 'Authenticated flag is written synchronously'
+    assert pending['n_login_count'] == before['n_login_count'] and \
+        pending['d_current_login_at'] == before['d_current_login_at'], \
+        'Login audit fields are buffered in memory'
+
+    assert login_audit_buffer.flush() == 1, 'One user has been flushed'
+    after = audit()
+    assert after['n_login_count'] == before['n_login_count'] + 3, 'Login count is flushed into database'
+    assert after['d_current_login_at'] > after['d_last_login_at'] > (
+        before['d_current_login_at'] or datetime.datetime.min
+    ), 'Last login is the second to last one'
+
+    # normal logout
+    api.assert_normal_action(api.logout())
+
+
+def test_refresh_in_one_transaction(app, client, api):
+    # normal login
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    statements = []
+    commits = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement.split()[0].upper())
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    event.listen(engine, 'commit', on_commit)
+    try:
+        api.access_token, refresh_token = api.assert_normal_refresh(
+            api.refresh(refresh_token)
+        )
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+        event.remove(engine, 'commit', on_commit)
+
+    assert statements == ['SELECT', 'DELETE', 'DELETE', 'INSERT'], \
+        'One verify, two deletes and one multi-row insert'
+    assert len(commits) == 1, 'Refresh token pair in one transaction'
+
+    # the refresh token can be used only once
+    resp = api.refresh(refresh_token)
+    assert resp.status_code == 200
+    assert api.refresh(refresh_token).status_code == 401
+
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+    # normal logout
+    api.assert_normal_action(api.logout())
+
+
+def test_refresh_redeemed_once(app, client, api, monkeypatch):
+    # normal login
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+    payload, _ = decode_jwt_token(refresh_token)
+    pair_digest = TokenService().pair_digest(payload['uid'], payload['rds'])
+
+    verify = TokenService.verify
+
+    def verify_then_redeem(self, category, owner_id, token, track_access=True):
+        result = verify(self, category, owner_id, token, track_access)
+
+        # a concurrent refresh with the same token commits first
+        table = TokenModel.__table__
+        database.get_engine(app).execute(table.delete().where(table.c.c_token_hash == hash_token(token)))
+        return result
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    monkeypatch.setattr(TokenService, 'verify', verify_then_redeem)
+    assert api.refresh(refresh_token).status_code == 401, 'The refresh token is redeemed only once'
+    assert not get_token_denylist().is_revoked(pair_digest), 'A failed refresh revokes nothing'
+    monkeypatch.undo()
+
+    # normal logout
+    api.assert_normal_action(api.logout())
+
+
+def test_login_when_hasher_busy(client, api, monkeypatch):
+    def busy(*args):
+        raise PasswordHasherBusy()
+
+    monkeypatch.setattr(password_hasher, 'verify_and_update', busy)
+    rv = api.login('luonbin@hotmail.com', 'Test001')
+    assert rv.status_code == 503, 'Reject login when password hashing pool is saturated'
+
+
+def test_login_throttle(app, client, api, monkeypatch):
+    app.config['LOGIN_THROTTLE_ACCOUNT_LIMIT'] = 3
+    app.config['LOGIN_THROTTLE_IP_LIMIT'] = 5
+    init_throttle(app)
+
+    verified = []
+    verify = password_hasher.verify_and_update
+    monkeypatch.setattr(password_hasher, 'verify_and_update', lambda *args: verified.append(1) or verify(*args))
+
+    for _ in range(3):
+        assert api.login('luonbin@hotmail.com', 'Wrong001').status_code == 401
+    assert len(verified) == 3, 'Failed logins are verified'
+
+    rv = api.login('luonbin@hotmail.com', 'Test001')
+    assert rv.status_code == 429 and len(verified) == 3, \
+        'Reject login on throttled account before hashing'
+
+    def login_from(email, real_ip):
+        return client.post(api.api_url_login, data=json.dumps({'email': email, 'password': 'Test001'}), headers={
+            'Content-Type': 'application/json',
+            'X-Real-IP': real_ip,
+        })
+
+    # unknown accounts are counted against the IP, whatever the client claims
+    for idx in range(2):
+        assert login_from('nobody{}@hotmail.com'.format(idx), '10.0.0.{}'.format(idx)).status_code == 401
+    assert login_from('other@hotmail.com', '10.0.0.9').status_code == 429, \
+        'Reject login from throttled IP'
+
+    stats = get_login_throttle().stats()
+    assert stats['rejected'] == 2 and stats['failures'] == 5, 'Count throttled logins'
+
+
+def test_rehash_on_login(app, client, api):
+    from flashboard.utils import prepare_for_hash
+
+    # a password hashed by passlib's custom_app_context
+    user = UserModel.query.filter(UserModel.email == 'luonbin@hotmail.com').first()
+    user.password = sha512_crypt.using(rounds=1000).hash(prepare_for_hash(
+        'Test001', app.config['SECURITY_PASSWORD_SALT'], user.private_salt
+    ))
+    database.db_session.commit()
+    assert password_hasher.needs_update(user.password), 'Legacy hash is outdated'
+
+    api.assert_normal_login(api.login('luonbin@hotmail.com', 'Test001'))
+
+    user = UserModel.query.filter(UserModel.email == 'luonbin@hotmail.com').first()
+    assert user.password.startswith('$pbkdf2-sha512$') and not password_hasher.needs_update(user.password), \
+        'Rehash outdated password on login'
+    api.assert_normal_login(api.login('luonbin@hotmail.com', 'Test001'))
+
+
+def test_bulk_roles(app, client, api):
+    usvc = UserService()
+    for idx in range(3):
+        usvc.register_user('team{}'.format(idx), 'team{}@flashboard.io'.format(idx), 'Test001')
+    team = ['team{}@flashboard.io'.format(idx) for idx in range(3)]
+
+    # normal login
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    usvc.revoke_role('luonbin@hotmail.com', 'admin')
+    database.db_session.commit()
+    assert api.grant_roles(team, ['operator']).status_code == 403, 'Only administrators can change roles'
+    assert usvc.grant_role('luonbin@hotmail.com', 'admin')
+
+    # grant roles in bulk, existing pairs and unknown ones are skipped
+    assert usvc.grant_roles(team[:1], ['operator']) == (1, '')
+    resp = api.grant_roles(team + ['nobody@flashboard.io'], ['operator', 'admin', 'nobody'])
+    json_resp = resp.get_json()
+    assert resp.status_code == 200 and json_resp['count'] == 5, 'Grant roles in bulk'
+    assert 'nobody@flashboard.io' in json_resp['message'] and 'nobody' in json_resp['message']
+    assert all(usvc.has_role(email, 'operator') and usvc.has_role(email, 'admin') for email in team)
+
+    # revoke roles in bulk
+    resp = api.revoke_roles(team, ['admin'])
+    assert resp.status_code == 200 and resp.get_json() == {'message': 'OK', 'count': 3}, 'Revoke roles in bulk'
+    assert not any(usvc.has_role(email, 'admin') for email in team)
+    assert all(usvc.has_role(email, 'operator') and usvc.has_role(email, 'user') for email in team)
+
+    # ids may be given as strings
+    user_ids, role_ids = usvc.resolve_users(team)[0], usvc.resolve_roles(['admin'])[0]
+    resp = api.grant_roles([str(user_id) for user_id in user_ids], [str(role_id) for role_id in role_ids])
+    assert resp.status_code == 200 and resp.get_json() == {'message': 'OK', 'count': 3}, 'Grant roles by ids'
+    assert all(usvc.has_role(email, 'admin') for email in team)
+
+    # normal logout
+    api.assert_normal_action(api.logout())
+
+
+def test_stats(app, client, api):
+    usvc = UserService()
+    api.access_token, refresh_token = api.assert_normal_login(
+        api.login('luonbin@hotmail.com', 'Test001')
+    )
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    assert api._api_get(api.api_url_stats).status_code == 403, 'Only administrators can read statistics'
+
+    assert usvc.grant_role('luonbin@hotmail.com', 'admin')
+    resp = api._api_get(api.api_url_stats)
+    json_resp = resp.get_json()
+    assert resp.status_code == 200 and app.config['SQLALCHEMY_DATABASE_URI'] in json_resp['pool']
+    assert 'TokenStatsBuffer' in json_resp['buffers']
+    assert json_resp['sql']['flashboard-api.app_stats']['requests'] >= 1, 'Requests are counted per endpoint'
+
+    # normal logout
+    api.assert_normal_action(api.logout())
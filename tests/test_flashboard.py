@@ -1,5 +1,639 @@
-from flashboard import __version__
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import pytest
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from flask_login import login_user
+from werkzeug.exceptions import Unauthorized
+
+from config.settings import Settings
+from flashboard import __version__, database, sqlstats
+from flashboard.buffers import WriteBehindBuffer
+from flashboard.cache import LocalStore, SharedTokenDenylist
+from flashboard.identity import identity_cache, init_identity, get_user_versions, SharedUserVersions, UserIdentity
+from flashboard.identity import SESSION_SNAPSHOT_KEY
+from flashboard.rbac import rbac_module, role_mask, module_mask, user_role_mask, create_all_roles
+from flashboard.models import RoleModel, TokenModel, UserModel
+from flashboard.services import TokenService, UserService
+from flashboard.throttle import SlidingWindowCounter, SharedSlidingWindowCounter
+from flashboard.utils import hash_token
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_purge_expired_tokens(app):
+    tsvc = TokenService()
+
+    # add expired tokens and a valid one
+    for _ in range(5):
+        assert tsvc.create(TokenService.TOKEN_USER_ACTIVATION, 1, duration=-60)
+    valid_token = tsvc.create(TokenService.TOKEN_USER_ACTIVATION, 1, duration=60)
+    assert valid_token
+
+    count_before = tsvc.count()
+    rows, elapsed = tsvc.purge_expired(chunk_size=2)
+    count_after = tsvc.count()
+    assert rows >= 5 and count_before - rows == count_after and elapsed >= 0, \
+        'Purge all expired tokens chunk by chunk'
+
+    assert TokenModel.query.filter(TokenModel.id == valid_token.id).count() == 1, \
+        'Keep valid token'
+
+    rows, elapsed = tsvc.purge_expired(chunk_size=2)
+    assert rows == 0, 'Nothing to purge'
+
+
+def test_shared_token_denylist():
+    try:
+        db_fd, db_path = tempfile.mkstemp()
+
+        # two workers with their own connections to the same store
+        worker1 = SharedTokenDenylist(LocalStore(db_path), poll_interval=0)
+        worker2 = SharedTokenDenylist(LocalStore(db_path), poll_interval=0)
+
+        expiry = time.time() + 60
+        for idx in range(10000):
+            worker1.revoke(hash_token('token-{}'.format(idx)), expiry)
+        worker1.revoke(hash_token('expired-token'), time.time() - 1)
+
+        assert worker1.is_revoked(hash_token('token-0')), 'Revoked in current worker'
+        assert worker2.is_revoked(hash_token('token-9999')), 'Revoked in other worker'
+        assert len(worker2) == 10000, 'Expired tokens are not loaded'
+        assert not worker2.is_revoked(hash_token('expired-token')), 'Expired tokens are not denied'
+        assert not worker2.is_revoked(hash_token('valid-token')), 'Valid tokens are not denied'
+
+        # changes on both directions
+        worker2.revoke(hash_token('valid-token'), expiry)
+        assert worker1.is_revoked(hash_token('valid-token')), 'Revoked in other worker'
+
+        # lookups are served from the in-memory copy
+        worker2.poll_interval = 60
+        worker2.sync()
+        start = time.perf_counter()
+        for idx in range(10000):
+            worker2.is_revoked(hash_token('token-{}'.format(idx)))
+        assert (time.perf_counter() - start) / 10000 < 0.0001, 'Lookup in microseconds'
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+def test_sliding_window_counter():
+    try:
+        db_fd, db_path = tempfile.mkstemp()
+
+        for counter in [
+            SlidingWindowCounter(window=60, max_keys=3),
+            SharedSlidingWindowCounter(LocalStore(db_path), window=60),
+        ]:
+            now = 6000.0
+            for _ in range(10):
+                counter.hit('ip:127.0.0.1', now)
+            assert counter.count('ip:127.0.0.1', now) == 10, 'Count hits in current window'
+            assert counter.count('ip:127.0.0.2', now) == 0, 'Count hits per key'
+
+            # previous window is weighted by its overlap
+            assert counter.count('ip:127.0.0.1', now + 90) == 5, 'Half of previous window'
+            counter.hit('ip:127.0.0.1', now + 90)
+            assert counter.count('ip:127.0.0.1', now + 90) == 6, 'Slide into next window'
+            assert counter.count('ip:127.0.0.1', now + 180) == 0, 'Expire old windows'
+
+            counter.reset('ip:127.0.0.1')
+            assert counter.count('ip:127.0.0.1', now + 90) == 0, 'Reset key'
+
+        # bounded memory
+        counter = SlidingWindowCounter(window=60, max_keys=3)
+        for idx in range(5):
+            counter.hit('ip:{}'.format(idx))
+        assert len(counter) == 3 and counter.count('ip:0') == 0 and counter.count('ip:4') == 1, \
+            'Evict least recently used keys'
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+def test_user_identity_cache(app, client):
+    resp = client.post('/sys/login', data={'email': 'luonbin@hotmail.com', 'password': 'Test001'})
+    assert resp.status_code == 302, 'Login through the view'
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        assert client.get('/sys/home').status_code == 200
+        assert len(identity_cache) == 1, 'Cache identity of current user'
+
+        del statements[:]
+        assert client.get('/sys/home').status_code == 200
+        assert statements == [], 'Load current user from cache'
+
+        # any change of the user drops its identity
+        usvc = UserService()
+        user = usvc.load_user('luonbin@hotmail.com')
+        user.name = 'robin2'
+        assert usvc.save_item(user)
+        assert identity_cache.get('luonbin@hotmail.com') is None, 'Drop identity on update'
+
+        resp = client.get('/sys/home')
+        assert resp.status_code == 200 and b'robin2' in resp.data, 'Reload identity'
+
+        # so do changes of its roles
+        assert usvc.grant_role('luonbin@hotmail.com', 'admin')
+        assert identity_cache.get('luonbin@hotmail.com') is None, 'Drop identity on role changes'
+
+        # changes made by other workers only bump the version of the user
+        assert client.get('/sys/home').status_code == 200
+        database.get_engine(app).execute(UserModel.__table__.update().values(c_name='robin4'))
+        get_user_versions().bump('luonbin@hotmail.com')
+        resp = client.get('/sys/home')
+        assert resp.status_code == 200 and b'robin4' in resp.data, 'Reload identity of other version'
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+
+def test_session_user_snapshot(app, client):
+    app.config['USER_IDENTITY_CACHE_SIZE'] = 0
+    app.config['SESSION_USER_SNAPSHOT'] = True
+    init_identity(app)
+
+    resp = client.post('/sys/login', data={'email': 'luonbin@hotmail.com', 'password': 'Test001'})
+    assert resp.status_code == 302, 'Login through the view'
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        assert client.get('/sys/home').status_code == 200
+        del statements[:]
+        assert client.get('/sys/home').status_code == 200
+        assert statements == [], 'Load current user from the session snapshot'
+
+        # any change of the user outdates the snapshot
+        usvc = UserService()
+        user = usvc.load_user('luonbin@hotmail.com')
+        user.name = 'robin3'
+        assert usvc.save_item(user)
+
+        del statements[:]
+        resp = client.get('/sys/home')
+        assert resp.status_code == 200 and b'robin3' in resp.data, 'Revalidate the snapshot'
+        assert len(statements) == 1, 'Reload the user once'
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    with client.session_transaction() as session:
+        assert SESSION_SNAPSHOT_KEY in session
+    assert client.get('/sys/logout').status_code == 302
+    with client.session_transaction() as session:
+        assert SESSION_SNAPSHOT_KEY not in session, 'Drop the snapshot on logout'
+
+    # versions shared by all workers
+    db_fd, db_path = tempfile.mkstemp()
+    try:
+        versions = SharedUserVersions(LocalStore(db_path), poll_interval=0)
+        other = SharedUserVersions(LocalStore(db_path))
+        assert versions.get('luonbin@hotmail.com') == 0
+        other.bump('luonbin@hotmail.com')
+        other.bump('robin@flashboard.io')
+        assert versions.get('luonbin@hotmail.com') == 1, 'Bumped by another worker'
+        versions.bump('luonbin@hotmail.com')
+        assert versions.get('luonbin@hotmail.com') == 2 and versions.get('robin@flashboard.io') == 1
+    finally:
+        os.close(db_fd)
+        os.unlink(db_path)
+
+
+def test_home_query_count(app, client):
+    resp = client.post('/sys/login', data={'email': 'luonbin@hotmail.com', 'password': 'Test001'})
+    assert resp.status_code == 302, 'Login through the view'
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        # without identity cache, user and roles are loaded in one query
+        app.config['USER_IDENTITY_CACHE_SIZE'] = 0
+        init_identity(app)
+        assert client.get('/sys/home').status_code == 200
+        assert len(statements) == 1 and 'sys_map_r2u' in statements[0], \
+            'Load user with its roles in one query'
+
+        # with identity cache, nothing is loaded
+        app.config['USER_IDENTITY_CACHE_SIZE'] = 16
+        init_identity(app)
+        assert client.get('/sys/home').status_code == 200
+        del statements[:]
+        assert client.get('/sys/home').status_code == 200
+        assert statements == [], 'No query with cached identity'
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    # role names are computed once and refreshed with roles
+    usvc = UserService()
+    user = usvc.load_user('luonbin@hotmail.com')
+    assert user.role_names == frozenset(role.name for role in user.roles) and user.has_role('user')
+    assert not user.has_role('operator') and usvc.has_role(user, user.roles[0]), 'Check role by name or RoleModel'
+    assert usvc.grant_role(user, 'operator')
+    assert usvc.has_role('luonbin@hotmail.com', 'operator'), 'Role names are refreshed on commit'
+
+
+def test_rbac_module(app):
+    assert role_mask(['user', 'admin']) == role_mask(['user']) | role_mask(['admin'])
+    assert module_mask('home') == role_mask(['user', 'operator', 'admin']), 'Compile roles of the module'
+    assert module_mask('sys', 'unknown') == role_mask(['anonymous', 'user', 'operator', 'admin'])
+
+    assert user_role_mask(frozenset(['operator'])) == role_mask(['operator']) and user_role_mask(None) == 0
+    assert user_role_mask(frozenset(['new_role'])) & module_mask('home') == 0, 'Unknown roles get their own bits'
+
+    # roles are loaded from database, not taken from the snapshot
+    user = UserService().load_user('luonbin@hotmail.com')
+    user, guest = UserIdentity.from_user(user), UserIdentity.from_user(user)
+    guest.email = 'guest@flashboard.io'
+
+    @rbac_module('home')
+    def view():
+        return 'OK'
+
+    with app.test_request_context():
+        login_user(user)
+        assert view() == 'OK', 'Access with any role of the module'
+
+    with app.test_request_context():
+        login_user(guest)
+        with pytest.raises(Unauthorized):
+            view()
+
+
+def test_permission_cache(app):
+    assert isinstance(get_user_versions(), SharedUserVersions), 'Share versions of users across workers by default'
+    assert get_user_versions().store.path.startswith(app.instance_path)
+
+    usvc = UserService()
+    email = 'luonbin@hotmail.com'
+    usvc.revoke_role(email, 'operator')
+    database.db_session.commit()
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        assert usvc.has_role(email, 'user') and not usvc.has_role(email, 'operator')
+        del statements[:]
+        assert usvc.has_role(email, 'user') and not usvc.has_role(email, 'anonymous')
+        assert statements == [], 'Check roles in memory'
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    # grant and revoke bump the version of the user
+    version = get_user_versions().get(email)
+    assert usvc.grant_role(email, 'operator') and usvc.has_role(email, 'operator'), 'Granted role'
+    assert get_user_versions().get(email) > version
+
+    assert usvc.revoke_role(email, 'operator') and not usvc.has_role(email, 'operator'), 'Revoked role'
+    database.db_session.rollback()
+    assert usvc.has_role(email, 'operator'), 'Revocation is rolled back'
+    assert usvc.revoke_role(email, 'operator')
+    database.db_session.commit()
+    assert not usvc.has_role(email, 'operator') and usvc.has_role(email, 'user'), \
+        'Revoke only the role of the user'
+
+
+def test_replica_routing(app):
+    # the replica is a copy of the primary which lags behind it
+    primary_path = app.config['SQLALCHEMY_DATABASE_URI'][len('sqlite:///'):]
+    db_fd, replica_path = tempfile.mkstemp()
+    shutil.copyfile(primary_path, replica_path)
+    database.get_engine(app).execute(
+        UserModel.__table__.update().values(c_name='robin-primary')
+    )
+
+    try:
+        app.config['SQLALCHEMY_REPLICA_URIS'] = ['sqlite:///' + replica_path]
+        database.init_db(app)
+        usvc = UserService()
+
+        ###########################################
+        #
+        # Core test cases start from here
+        #
+        ###########################################
+        assert usvc.id_to_name(1) == 'robin', 'Read from the replica'
+        assert usvc.execute_read_sql(text('SELECT c_name FROM sys_user')).scalar() == 'robin'
+
+        # the user loaded from the replica stays in the identity map
+        replica_user = usvc.load_raw_user('luonbin@hotmail.com')
+        assert replica_user.name == 'robin'
+        assert usvc.load_user('luonbin@hotmail.com').name == 'robin-primary', 'Load users from the primary'
+        assert replica_user.name == 'robin-primary', 'Refresh the user loaded from the replica'
+        assert usvc.execute_read_sql(text('SELECT c_name FROM sys_user')).scalar() == 'robin', 'Still read from the replica'
+
+        user = usvc.load_user('luonbin@hotmail.com')
+        user.login_count += 1
+        assert usvc.save_item(user)
+        assert usvc.id_to_name(1) == 'robin-primary', 'Read your writes from the primary'
+
+        # stickiness lasts one session
+        database.db_session.remove()
+        assert usvc.id_to_name(1) == 'robin'
+        usvc.execute_write_sql(text('UPDATE sys_user SET n_login_count = n_login_count + 1'))
+        assert usvc.id_to_name(1) == 'robin-primary'
+        database.db_session.remove()
+
+        # statements which write never go to a replica
+        usvc.execute_read_sql(text('UPDATE sys_user SET n_login_count = n_login_count + 1'))
+        assert usvc.id_to_name(1) == 'robin-primary', 'Wrote to the primary'
+        database.db_session.remove()
+    finally:
+        os.close(db_fd)
+        os.unlink(replica_path)
+
+
+def test_nested_transactions(app):
+    def role_names(prefix):
+        database.db_session.remove()
+        return sorted(
+            name for (name, ) in database.db_session.query(RoleModel.name).filter(RoleModel.name.like(prefix + '%'))
+        )
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    with database.db_trasaction() as txn:
+        assert database.in_transaction()
+        txn.save_item(RoleModel('nested-outer'))
+        with pytest.raises(ValueError):
+            with database.db_trasaction() as inner:
+                inner.save_item(RoleModel('nested-failed'))
+                inner.try_assert(True, 'roll back the savepoint only')
+        with database.db_trasaction() as inner:
+            inner.save_item(RoleModel('nested-inner'))
+    assert not database.in_transaction()
+    assert role_names('nested-') == ['nested-inner', 'nested-outer']
+
+    with pytest.raises(ValueError):
+        with database.db_trasaction() as txn:
+            with database.db_trasaction() as inner:
+                inner.save_item(RoleModel('undone-inner'))
+            txn.try_assert(True, 'roll back all of the transaction')
+    assert role_names('undone-') == []
+
+
+def test_concurrent_transactions(app):
+    threads, rounds = 8, 10
+    errors = []
+
+    def work(idx):
+        try:
+            with app.app_context():
+                for num in range(rounds):
+                    with database.db_trasaction() as txn:
+                        txn.save_item(RoleModel('stress-{}-{}-outer'.format(idx, num)))
+                        try:
+                            with database.db_trasaction() as inner:
+                                inner.save_item(RoleModel('stress-{}-{}-failed'.format(idx, num)))
+                                inner.try_assert(True, 'roll back the savepoint only')
+                        except ValueError:
+                            pass
+                        with database.db_trasaction() as inner:
+                            inner.save_item(RoleModel('stress-{}-{}-inner'.format(idx, num)))
+                    time.sleep(0)
+                    assert not database.in_transaction()
+        except Exception as exp:
+            errors.append(exp)
+        finally:
+            database.db_session.remove()
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    workers = [threading.Thread(target=work, args=(idx, )) for idx in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert errors == []
+    database.db_session.remove()
+    names = [name for (name, ) in database.db_session.query(RoleModel.name).filter(RoleModel.name.like('stress-%'))]
+    assert len(names) == threads * rounds * 2
+    assert not [name for name in names if name.endswith('-failed')], 'Failed savepoints are rolled back'
+
+
+def test_bulk_persistence(app):
+    def descriptions(prefix):
+        database.db_session.remove()
+        return dict(database.db_session.query(RoleModel.name, RoleModel.description).filter(
+            RoleModel.name.like(prefix + '%')
+        ))
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    items = [RoleModel('bulk-{}'.format(idx), 'saved') for idx in range(10)]
+    assert database.save_items(items, batch_size=4) == (10, [])
+    assert len(descriptions('bulk-')) == 10
+
+    # the duplicated name fails the 2nd batch only
+    items = [RoleModel('batch-{}'.format(idx)) for idx in range(7)] + [RoleModel('bulk-0'), RoleModel('batch-7')]
+    count, errors = database.save_items(items, batch_size=4)
+    assert count == 5 and [number for number, _ in errors] == [1]
+    assert sorted(descriptions('batch-')) == ['batch-0', 'batch-1', 'batch-2', 'batch-3', 'batch-7']
+
+    # existing rows are updated, new ones are inserted
+    items = [RoleModel('bulk-{}'.format(idx), 'upserted') for idx in range(5, 15)]
+    assert database.upsert_items(items, ['name'], batch_size=4) == (10, [])
+    roles = descriptions('bulk-')
+    assert len(roles) == 15
+    assert roles['bulk-0'] == 'saved' and roles['bulk-5'] == 'upserted' and roles['bulk-14'] == 'upserted'
+
+    # seeding pre-defined roles again is harmless
+    create_all_roles()
+    create_all_roles()
+    roles = descriptions('')
+    assert all(roles[role] == desc for role, desc in Settings().RBAC_ROLES.items())
+
+
+def test_read_only_requests(app, client):
+    commits = []
+
+    def on_commit(conn):
+        commits.append(conn)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'commit', on_commit)
+    try:
+        ###########################################
+        #
+        # Core test cases start from here
+        #
+        ###########################################
+        resp = client.post('/sys/login', data={'email': 'luonbin@hotmail.com', 'password': 'Test001'})
+        assert resp.status_code == 302 and commits, 'Commit login audit fields'
+
+        del commits[:]
+        app.config['USER_IDENTITY_CACHE_SIZE'] = 0
+        init_identity(app)
+        assert client.get('/sys/home').status_code == 200
+        assert commits == [], 'Skip the commit of requests which only read'
+
+        with app.test_request_context():
+            database.db_session.add(RoleModel('unflushed'))
+        assert commits, 'Commit pending objects in teardown'
+        assert database.db_session.query(RoleModel).filter(RoleModel.name == 'unflushed').count() == 1
+
+        del commits[:]
+        with app.test_request_context():
+            UserService().execute_write_sql(text("INSERT INTO sys_role (c_name) VALUES ('textual-write')"))
+            UserService().execute_read_sql(text("INSERT INTO sys_role (c_name) VALUES ('textual-read')"))
+        assert commits, 'Commit textual SQL which writes'
+        database.db_session.remove()
+        assert database.db_session.query(RoleModel).filter(RoleModel.name.like('textual-%')).count() == 2
+    finally:
+        event.remove(engine, 'commit', on_commit)
+
+    @database.read_only
+    def view():
+        return database.db_session.info.get('read_only')
+
+    assert view() and 'read_only' not in database.db_session.info
+
+
+def test_sql_stats(app, client, caplog):
+    resp = client.post('/sys/login', data={'email': 'luonbin@hotmail.com', 'password': 'Test001'})
+    assert resp.status_code == 302, 'Login through the view'
+    app.config['USER_IDENTITY_CACHE_SIZE'] = 0
+    init_identity(app)
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    assert 'X-DB-Statements' not in client.get('/sys/home').headers, 'No header by default'
+
+    app.config['SQL_STATS_HEADER'] = True
+    sqlstats.sql_stats.clear()
+    resp = client.get('/sys/home')
+    assert resp.status_code == 200
+    assert resp.headers['X-DB-Statements'] == '1' and float(resp.headers['X-DB-Time']) > 0
+
+    stats = sqlstats.sql_stats.snapshot()['flashboard.home']
+    assert stats['requests'] == 1 and stats['statements'] == 1 and stats['slow_queries'] == 0
+
+    # all statements are slow with a zero threshold
+    threshold = sqlstats.slow_query_threshold
+    sqlstats.slow_query_threshold = 0
+    try:
+        with caplog.at_level('WARNING', logger='flashboard.slow_query'):
+            assert client.get('/sys/home').status_code == 200
+    finally:
+        sqlstats.slow_query_threshold = threshold
+    assert [record for record in caplog.records if '[flashboard.home]' in record.getMessage()]
+    assert sqlstats.sql_stats.snapshot()['flashboard.home']['slow_queries'] == 1
+
+
+def test_sql_stats_of_teardown(app, client):
+    @app.route('/teardown-write')
+    def teardown_write():
+        # flushed by the commit in teardown
+        database.db_session.add(RoleModel('teardown-write'))
+        return 'OK'
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = database.db_session.get_bind()
+    event.listen(engine, 'before_cursor_execute', on_execute)
+    try:
+        assert client.get('/teardown-write').status_code == 200
+    finally:
+        event.remove(engine, 'before_cursor_execute', on_execute)
+
+    assert [statement for statement in statements if statement.startswith('INSERT INTO sys_role')]
+    assert sqlstats.sql_stats.snapshot()['teardown_write']['statements'] == len(statements), \
+        'Count statements flushed by the teardown commit'
+
+
+def test_write_behind_retry():
+    class CounterBuffer(WriteBehindBuffer):
+        def __init__(self):
+            super().__init__(max_retries=2)
+            self.applied = {}
+            self.failures = 0
+
+        def merge(self, old_value, new_value):
+            return old_value + new_value
+
+        def apply(self, conn, items):
+            if self.failures:
+                self.failures -= 1
+                raise OperationalError('UPDATE', {}, Exception('database is locked'))
+            for key, value in items.items():
+                self.applied[key] = self.applied.get(key, 0) + value
+
+    class IncompleteBuffer(WriteBehindBuffer):
+        def merge(self, old_value, new_value):
+            return new_value
+
+    ###########################################
+    #
+    # Core test cases start from here
+    #
+    ###########################################
+    with pytest.raises(TypeError):
+        IncompleteBuffer()
+
+    buffer = CounterBuffer()
+    buffer.configure(create_engine('sqlite://'))
+    buffer._pid = os.getpid()  # no flusher thread
+    buffer.add('a', 1)
+    buffer.add('b', 2)
+
+    # changes of the failed flush are merged with the ones added since then
+    buffer.failures = 1
+    assert buffer.flush() == 0 and len(buffer) == 2
+    buffer.add('a', 3)
+    assert buffer.flush() == 2 and buffer.applied == {'a': 4, 'b': 2}
+    assert buffer.retried_rows == 2 and buffer.failed_rows == 0
+
+    # changes are dropped after max_retries failed flushes
+    buffer.add('c', 5)
+    buffer.failures = 3
+    assert buffer.flush() == 0 and buffer.flush() == 0 and len(buffer) == 1
+    assert buffer.flush() == 0 and len(buffer) == 0 and buffer.failed_rows == 1
+    assert 'c' not in buffer.applied